@@ -0,0 +1,314 @@
+"""
+Benchmarks for the photo sorting pipeline.
+
+    python bench.py hash <image folder>
+    python bench.py corpus <folder> [--count N] [--seed S]
+    python bench.py pipeline <folder> [--count N] [--seed S]
+    python bench.py startup [--runs N]
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+from datetime import datetime, timedelta
+import functools
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import piexif
+import pillow_heif
+from PIL import Image
+
+import main
+
+# locations the synthetic photos are taken at, jittered by up to ~1km per photo
+CORPUS_LOCATIONS = [(46.0569, 14.5058), (48.8566, 2.3522), (41.9028, 12.4964), (40.7128, -74.0060), (35.6762, 139.6503)]
+CORPUS_IMAGE_SIZE = (640, 480)
+
+# startup budget in seconds for the median of fresh interpreters, on top of the median of a bare `python -c pass`,
+# so site packages and a slow machine don't count against it. The startup benchmark fails above it.
+# Everything heavy in main.py is imported lazily, a new eager import shows up here first.
+# main.py run as a script is compiled on every start, which --help pays for as well.
+STARTUP_BUDGET = {
+    "import main": 0.06,
+    "main.py --help": 0.12,
+}
+STARTUP_BASELINE = ["-c", "pass"]
+STARTUP_COMMANDS = {
+    "import main": ["-c", "import main"],
+    "main.py --help": ["main.py", "--help"],
+}
+
+
+def benchmark_image_hash(folder):
+    """Compare full-resolution and reduced-resolution perceptual hashing on every image in folder."""
+    full_times = []
+    reduced_times = []
+    distances = []
+
+    for file_name in sorted(os.listdir(folder)):
+        file_path = os.path.join(folder, file_name)
+        if not os.path.isfile(file_path) or main.is_video_file(file_name):
+            continue
+
+        # read the file once so both variants start from the page cache
+        with open(file_path, "rb") as file:
+            file.read()
+
+        start = time.perf_counter()
+        full_hash = main.get_image_hash(file_path, reduced=False)
+        full_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        reduced_hash = main.get_image_hash(file_path)
+        reduced_time = time.perf_counter() - start
+
+        if full_hash is None or reduced_hash is None:
+            continue
+        full_times.append(full_time)
+        reduced_times.append(reduced_time)
+        distances.append(full_hash - reduced_hash)
+
+    if not distances:
+        print("No hashable images found in " + folder)
+        return
+
+    print(f"Images hashed: {len(distances)}")
+    print(f"Full decode:    {sum(full_times):.3f} s ({1000 * sum(full_times) / len(full_times):.2f} ms/image)")
+    print(f"Reduced decode: {sum(reduced_times):.3f} s ({1000 * sum(reduced_times) / len(reduced_times):.2f} ms/image)")
+    print(f"Speedup: {sum(full_times) / sum(reduced_times):.2f}x")
+    print(f"Hash distance to full decode: mean {sum(distances) / len(distances):.2f} bits, max {max(distances)} bits, "
+          f"identical {100 * distances.count(0) / len(distances):.1f}%")
+
+
+def to_gps_rational(value):
+    degrees = int(value)
+    minutes = int((value - degrees) * 60)
+    seconds = round((value - degrees - minutes / 60) * 3600 * 100)
+    return ((degrees, 1), (minutes, 1), (seconds, 100))
+
+def make_exif(rng, taken, with_gps):
+    date_time = taken.strftime("%Y:%m:%d %H:%M:%S").encode()
+    gps = {}
+    if with_gps:
+        latitude, longitude = rng.choice(CORPUS_LOCATIONS)
+        latitude += rng.uniform(-0.01, 0.01)
+        longitude += rng.uniform(-0.01, 0.01)
+        gps = {
+            piexif.GPSIFD.GPSLatitudeRef: b"N" if latitude >= 0 else b"S",
+            piexif.GPSIFD.GPSLatitude: to_gps_rational(abs(latitude)),
+            piexif.GPSIFD.GPSLongitudeRef: b"E" if longitude >= 0 else b"W",
+            piexif.GPSIFD.GPSLongitude: to_gps_rational(abs(longitude)),
+        }
+    return piexif.dump({
+        "0th": {piexif.ImageIFD.DateTime: date_time},
+        "Exif": {piexif.ExifIFD.DateTimeOriginal: date_time},
+        "GPS": gps,
+    })
+
+def make_image(rng, size):
+    """Blocky random image, coarse enough that JPEG/HEIC sizes stay realistic and perceptual hashes differ."""
+    blocks = np.random.default_rng(rng.getrandbits(32)).integers(0, 256, (size[1] // 16, size[0] // 16, 3), dtype=np.uint8)
+    return Image.fromarray(blocks).resize(size, Image.BILINEAR)
+
+def make_mp4(rng, path, taken, duration):
+    """Minimal MP4 with an ftyp, an mdat and a moov/mvhd carrying the creation time, like a phone writes it."""
+    def box(box_type, body):
+        return struct.pack(">I4s", 8 + len(body), box_type) + body
+
+    creation_time = int((taken - main.MP4_EPOCH.replace(tzinfo=None)).total_seconds())
+    mvhd = b"\0\0\0\0" + struct.pack(">IIII", creation_time, creation_time, 1000, int(duration * 1000)) + b"\0" * 80
+    with open(path, "wb") as file:
+        file.write(box(b"ftyp", b"isom\0\0\0\0isommp41"))
+        file.write(box(b"mdat", rng.randbytes(64 * 1024)))
+        file.write(box(b"moov", box(b"mvhd", mvhd)))
+
+def generate_corpus(folder, count=200, seed=0):
+    """
+    Fill folder with a reproducible mix of count source files: JPEG and HEIC photos with EXIF DateTime and
+    mostly GPS, MP4 videos with an mvhd creation time, broken files, and " - Copy"/" (n)" copies of earlier files.
+    """
+    rng = random.Random(seed)
+    pillow_heif.register_heif_opener()
+    os.makedirs(folder, exist_ok=True)
+    start = datetime(2023, 1, 1)
+    created_files = []
+
+    for index in range(count):
+        taken = start + timedelta(seconds=rng.randrange(365 * 24 * 3600))
+        kind = rng.random()
+        if created_files and kind < 0.1:
+            original_name = rng.choice(created_files)
+            base, extension = os.path.splitext(original_name)
+            copy_name = base + rng.choice([" - Copy", f" ({rng.randint(1, 3)})"]) + extension
+            if not os.path.exists(os.path.join(folder, copy_name)):
+                shutil.copy2(os.path.join(folder, original_name), os.path.join(folder, copy_name))
+            continue
+        if kind < 0.13:
+            with open(os.path.join(folder, f"BROKEN_{index:05d}.jpg"), "wb") as file:
+                file.write(rng.randbytes(rng.randint(0, 4096)))
+            continue
+
+        if kind < 0.23:
+            file_name = f"VID_{index:05d}.mp4"
+            make_mp4(rng, os.path.join(folder, file_name), taken, rng.uniform(2, 60))
+        elif kind < 0.4:
+            file_name = f"IMG_{index:05d}.heic"
+            make_image(rng, CORPUS_IMAGE_SIZE).save(os.path.join(folder, file_name), format="HEIF", exif=make_exif(rng, taken, rng.random() < 0.8))
+        else:
+            file_name = f"IMG_{index:05d}.jpg"
+            make_image(rng, CORPUS_IMAGE_SIZE).save(os.path.join(folder, file_name), "JPEG", quality=90, exif=make_exif(rng, taken, rng.random() < 0.8))
+        created_files.append(file_name)
+
+    print(f"Generated {len(os.listdir(folder))} files in {folder}")
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def get_max_rss():
+    """Peak resident set size of this process in bytes, ru_maxrss is in KiB on Linux and in bytes on macOS."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+def measure_stage(function, items):
+    """
+    Run a stage inside a fresh worker process: returns (results, latencies, errors, stage time, peak RSS growth).
+    RSS includes the native decode buffers of libjpeg and libheif that Python allocation tracing doesn't see.
+    """
+    pillow_heif.register_heif_opener()
+    main.setup_logging("ERROR")
+    # the backends are loaded before the baseline, so the growth is what the stage itself needed
+    for backend in (main.np, main.Image, main.imagehash, main.reverse_geocode):
+        backend.__name__
+    baseline_rss = get_max_rss()
+
+    latencies = []
+    results = []
+    errors = 0
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        stage_start = time.perf_counter()
+        for item in items:
+            start = time.perf_counter()
+            try:
+                results.append(function(item))
+            except Exception:
+                results.append(None)
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+        stage_time = time.perf_counter() - stage_start
+    return results, latencies, errors, stage_time, get_max_rss() - baseline_rss
+
+def run_stage(name, function, items):
+    """
+    Call function on every item, timing each call. Every stage runs in its own spawned process, so the peak
+    memory is the RSS high-water mark the stage reached and not one left over by an earlier stage.
+    Errors are counted, not raised, broken files are part of the corpus.
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        results, latencies, errors, stage_time, peak_memory = executor.submit(measure_stage, function, items).result()
+
+    if latencies:
+        print(f"{name:<16} {len(latencies):>6} {errors:>6} {len(latencies) / stage_time:>10.1f} "
+              f"{1000 * percentile(latencies, 0.5):>9.3f} {1000 * percentile(latencies, 0.99):>9.3f} {peak_memory / 2**20:>9.2f}")
+    return results
+
+def move_file_name(file_name, source_folder, target_folder):
+    main.move_files(source_folder, [file_name], target_folder)
+
+def benchmark_pipeline(folder, count=200, seed=0):
+    """Time every stage of the pipeline on the corpus in folder, generating it first if the folder is empty."""
+    if not os.path.isdir(folder) or not os.listdir(folder):
+        generate_corpus(folder, count, seed)
+    pillow_heif.register_heif_opener()
+
+    file_paths = sorted(entry.path for _, entry in main.scan_files(folder))
+    image_paths = [path for path in file_paths if not main.is_video_file(path)]
+    video_paths = [path for path in file_paths if main.is_video_file(path)]
+
+    print(f"{'stage':<16} {'files':>6} {'errors':>6} {'files/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'peak MiB':>9}")
+    exif_data = run_stage("extract_exif", main.extract_exif, image_paths)
+    run_stage("get_image_hash", main.get_image_hash, image_paths)
+    run_stage("media_created", main.get_media_created, video_paths)
+    coordinates = [(data["GPS"]["Latitude"], data["GPS"]["Longitude"]) for data in exif_data if data and "GPS" in data]
+    run_stage("geocode", main.get_data_from_geocode, coordinates)
+
+    # moves run on a scratch copy so the corpus can be reused by the next run
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(folder))) as scratch_folder:
+        source_folder = os.path.join(scratch_folder, "source")
+        target_folder = os.path.join(scratch_folder, "target")
+        shutil.copytree(folder, source_folder)
+        os.makedirs(target_folder)
+        file_names = sorted(os.listdir(source_folder))
+        run_stage("move_files", functools.partial(move_file_name, source_folder=source_folder, target_folder=target_folder), file_names)
+
+def time_interpreter(arguments, runs, cwd):
+    """Return the wall times of running the interpreter with arguments in runs fresh processes."""
+    run_times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + arguments, cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+        run_times.append(time.perf_counter() - start)
+    return run_times
+
+def benchmark_startup(runs=7):
+    """
+    Time each startup command in fresh interpreters and compare what it adds to a bare interpreter start
+    with STARTUP_BUDGET, return False if one is over it.
+    """
+    repository_folder = os.path.dirname(os.path.abspath(__file__))
+    baseline_time = statistics.median(time_interpreter(STARTUP_BASELINE, runs, repository_folder))
+    print(f"{'python -c pass':<16} median {1000 * baseline_time:7.1f} ms")
+    within_budget = True
+    for name, arguments in STARTUP_COMMANDS.items():
+        run_times = time_interpreter(arguments, runs, repository_folder)
+        overhead = statistics.median(run_times) - baseline_time
+        status = "ok" if overhead <= STARTUP_BUDGET[name] else "OVER BUDGET"
+        within_budget = within_budget and overhead <= STARTUP_BUDGET[name]
+        print(f"{name:<16} median {1000 * statistics.median(run_times):7.1f} ms, overhead {1000 * overhead:7.1f} ms, "
+              f"budget {1000 * STARTUP_BUDGET[name]:5.0f} ms  {status}")
+    return within_budget
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for the photo sorting pipeline")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    hash_parser = subparsers.add_parser("hash", help="full vs reduced resolution perceptual hashing")
+    hash_parser.add_argument("folder")
+
+    corpus_parser = subparsers.add_parser("corpus", help="generate a synthetic source folder")
+    pipeline_parser = subparsers.add_parser("pipeline", help="time every pipeline stage on a synthetic corpus")
+    for stage_parser in (corpus_parser, pipeline_parser):
+        stage_parser.add_argument("folder")
+        stage_parser.add_argument("--count", type=int, default=200)
+        stage_parser.add_argument("--seed", type=int, default=0)
+
+    startup_parser = subparsers.add_parser("startup", help="check interpreter startup against the tracked budget")
+    startup_parser.add_argument("--runs", type=int, default=7)
+
+    args = parser.parse_args(argv)
+    pillow_heif.register_heif_opener()
+    # broken files in the corpus are expected, only failures of the benchmark itself should show up
+    main.setup_logging("ERROR")
+
+    if args.benchmark == "hash":
+        benchmark_image_hash(args.folder)
+    elif args.benchmark == "corpus":
+        generate_corpus(args.folder, args.count, args.seed)
+    elif args.benchmark == "pipeline":
+        benchmark_pipeline(args.folder, args.count, args.seed)
+    elif args.benchmark == "startup":
+        if not benchmark_startup(args.runs):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    run()
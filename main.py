@@ -1,169 +1,935 @@
 import os
 import configparser
 import shutil
-from PIL import Image, ExifTags
-import pillow_heif
-from PIL.ExifTags import TAGS, GPSTAGS
-import imagehash
-from collections import defaultdict
+import argparse
+import importlib
+import threading
+from collections import defaultdict, OrderedDict, deque
 import re
-import reverse_geocode
-import ffmpeg
 from random import randint
 from fractions import Fraction
-import piexif
+import struct
+import io
+import math
+import hashlib
+import sqlite3
+import time
+import json
 from typing import List
-import static_ffmpeg
-static_ffmpeg.add_paths()
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from functools import lru_cache
+from contextlib import contextmanager, nullcontext, AsyncExitStack
+import errno
+import logging
+import sys
+
+class LazyModule:
+    """
+    Stand-in for a heavy dependency that is imported on first attribute access, so commands and tools that only
+    rename and move files never load it. on_import runs once, right after the module has been imported.
+    """
 
-def extract_exif(file_path):
+    def __init__(self, module_name, on_import=None):
+        self.module_name = module_name
+        self.on_import = on_import
+        self.module = None
+        self.lock = threading.Lock()
+
+    def __getattr__(self, attribute):
+        if self.module is None:
+            with self.lock:
+                if self.module is None:
+                    module = importlib.import_module(self.module_name)
+                    if self.on_import is not None:
+                        self.on_import(module)
+                    self.module = module
+        return getattr(self.module, attribute)
+
+def add_static_ffmpeg_paths(module):
+    # static_ffmpeg may download or verify its binaries, only done once ffmpeg/ffprobe are actually needed
+    importlib.import_module("static_ffmpeg").add_paths()
+
+np = LazyModule("numpy")
+imagehash = LazyModule("imagehash")
+reverse_geocode = LazyModule("reverse_geocode")
+pillow_heif = LazyModule("pillow_heif")
+# the HEIF opener is registered as soon as Pillow is used, so Image.open handles .heic in every process
+Image = LazyModule("PIL.Image", on_import=lambda module: pillow_heif.register_heif_opener())
+ffmpeg = LazyModule("ffmpeg", on_import=add_static_ffmpeg_paths)
+# only the concurrent transfer batches need an event loop
+asyncio = LazyModule("asyncio")
+
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+HEIF_EXTENSIONS = ('.heic', '.heif')
+# variants of the same picture with these extensions are ranked against each other, later is better when all else is equal
+QUALITY_PRIORITY = ('.jpg', '.jpeg', '.heic')
+# names given to sorted files: {Country Code}_{YYYYMMDD}_{HHMMSS}, the country is missing for videos until placement,
+# _{sub-second time} and -{sequence} are only added when the name is already taken.
+# Phones name their photos {YYYYMMDD}_{HHMMSS} too, so parse_sorted_name only accepts that form for videos.
+SORTED_NAME_PATTERN = re.compile(r"^(?:(?P<country>[A-Z]{2})_)?(?P<date>\d{8})_(?P<time>\d{6})(?:_(?P<subsec>\d+))?(?:-(?P<sequence>\d+))?$")
+
+# JPEG start-of-frame markers: C0 to CF except DHT (C4), JPG (C8) and DAC (CC)
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# upper bounds for the header reads, anything bigger is not a sane metadata block
+MAX_METADATA_BOX_SIZE = 4 * 1024 * 1024
+MAX_EXIF_SIZE = 1024 * 1024
+
+MP4_EXTENSIONS = ('.mp4', '.mov', '.m4v')
+VIDEO_EXTENSIONS = ('.mp3',) + MP4_EXTENSIONS
+# mvhd times are seconds since midnight 1904-01-01 UTC
+MP4_EPOCH = datetime(1904, 1, 1, tzinfo=timezone.utc)
+
+# content based video matching: frames sampled per clip, allowed duration difference in seconds,
+# allowed differing bits per frame hash and how much larger a re-export may be than the original
+VIDEO_FINGERPRINT_FRAMES = 4
+VIDEO_DURATION_TOLERANCE = 1.0
+VIDEO_FRAME_HAMMING_THRESHOLD = 6
+VIDEO_MAX_SIZE_RATIO = 8
+
+# images are decoded at no less than this size for perceptual hashing, average_hash only looks at 8x8 pixels
+HASH_DECODE_SIZE = 128
+HASH_MIN_THUMBNAIL_SIZE = 64
+# allowed differing bits of the perceptual hashes of two files with the same name that are ranked as variants of one picture
+VARIANT_HAMMING_THRESHOLD = 6
+
+# TIFF field type -> (struct format, size in bytes)
+TIFF_TYPES = {1: ("B", 1), 2: ("s", 1), 3: ("H", 2), 4: ("I", 4), 5: ("II", 8), 7: ("s", 1), 9: ("i", 4), 10: ("ii", 8)}
+
+# timing histograms use power of two buckets starting at 1 microsecond, the last one is open ended
+HISTOGRAM_BUCKETS = 32
+
+logger = logging.getLogger("photo_sorter")
+
+def log_event(level, message, **fields):
+    """
+    Log message formatted with fields, which are also kept as separate keys in the JSON log.
+    Nothing is formatted unless the level is enabled, so per-file debug events cost next to nothing.
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, message.format(**fields), extra={"fields": fields})
+
+class JsonLinesFormatter(logging.Formatter):
+    """One JSON object per line: time, level, message and the fields passed to log_event."""
+
+    def format(self, record):
+        entry = {"time": record.created, "level": record.levelname, "message": record.getMessage()}
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def setup_logging(level="INFO", log_path=""):
+    """Log plain messages to stdout at level and, with log_path, the same events as JSON lines to a file."""
+    logger.setLevel(level)
+    logger.handlers.clear()
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(console_handler)
+    if log_path:
+        file_handler = logging.FileHandler(log_path)
+        file_handler.setFormatter(JsonLinesFormatter())
+        logger.addHandler(file_handler)
+
+class Metrics:
+    """
+    Counters and timing histograms for the stages of a run (decode, exif, hash, geocode, probe, move, ...).
+    Histograms have fixed log2 buckets, so a stage takes the same memory however many files it sees.
+    Worker processes record into their own instance and send a snapshot back with every result,
+    threads (transfers, ffprobe and ffmpeg calls) record into the shared one under its lock.
+    """
 
-    pillow_heif.register_heif_opener()
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = defaultdict(int)
+            self.timings = {} # stage -> [calls, total seconds, max seconds, bucket counts]
+            self.start_time = time.perf_counter()
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            timing = self.timings.get(stage)
+            if timing is None:
+                timing = self.timings[stage] = [0, 0.0, 0.0, [0] * HISTOGRAM_BUCKETS]
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+            timing[3][min(max(int(seconds * 1e6), 1).bit_length() - 1, HISTOGRAM_BUCKETS - 1)] += 1
+
+    @contextmanager
+    def timed(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self.lock:
+            return {"counters": dict(self.counters),
+                    "timings": {stage: [calls, total, maximum, list(buckets)] for stage, (calls, total, maximum, buckets) in self.timings.items()}}
+
+    def merge(self, snapshot):
+        with self.lock:
+            for name, value in snapshot["counters"].items():
+                self.counters[name] += value
+            for stage, (calls, total, maximum, buckets) in snapshot["timings"].items():
+                timing = self.timings.get(stage)
+                if timing is None:
+                    self.timings[stage] = [calls, total, maximum, list(buckets)]
+                    continue
+                timing[0] += calls
+                timing[1] += total
+                timing[2] = max(timing[2], maximum)
+                timing[3] = [count + other for count, other in zip(timing[3], buckets)]
+
+    def percentile(self, stage, fraction):
+        """Upper bound of the histogram bucket holding the given fraction of the calls, in seconds."""
+        calls, _, maximum, buckets = self.timings[stage]
+        seen = 0
+        for bucket, count in enumerate(buckets):
+            seen += count
+            if seen >= fraction * calls:
+                return min(2 ** (bucket + 1) / 1e6, maximum)
+        return maximum
+
+    def print_summary(self):
+        elapsed = time.perf_counter() - self.start_time
+        log_event(logging.INFO, "Run summary: {elapsed:.2f} s", elapsed=elapsed)
+        # stage times are summed over worker processes, so the shares can add up to more than 100%
+        for stage, (calls, total, maximum, _) in sorted(self.timings.items(), key=lambda item: -item[1][1]):
+            log_event(logging.INFO, "  {stage:<18} {calls:>7} calls {total:>9.3f} s {share:>6.1f}%  "
+                      "p50 {p50:.2f} ms  p99 {p99:.2f} ms  max {max:.2f} ms",
+                      stage=stage, calls=calls, total=total, share=100 * total / elapsed if elapsed else 0.0,
+                      p50=1000 * self.percentile(stage, 0.5), p99=1000 * self.percentile(stage, 0.99), max=1000 * maximum)
+        if self.counters:
+            log_event(logging.INFO, "  counters: {counters}", counters=dict(sorted(self.counters.items())))
+
+metrics = Metrics()
+
+@contextmanager
+def profiled(profile_path=""):
+    """Run the block under cProfile when profile_path is set, saving the stats there and logging the top functions."""
+    if not profile_path:
+        yield
+        return
+    # only profiled runs pay for importing the profiler
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(20)
+        log_event(logging.INFO, "Profile saved to {path}\n{report}", path=profile_path, report=report.getvalue())
+
+def iter_jpeg_segments(file):
+    """
+    Yield (marker, segment length) for the JPEG segments before the pixel data, reading only the marker headers.
+    The file is positioned at the start of each segment body, the next one is found whatever the caller read.
+    """
+    if file.read(2) != b"\xff\xd8":
+        return
 
-    file_extension = os.path.splitext(file_path)[1].lower()
+    while True:
+        header = file.read(4)
+        if len(header) < 4 or header[0] != 0xFF:
+            return
+        marker = header[1]
+        # standalone markers and padding carry no length
+        if marker == 0xFF:
+            file.seek(-3, os.SEEK_CUR)
+            continue
+        # start of scan / end of image, the metadata segments are always before the pixel data
+        if marker in (0xDA, 0xD9):
+            return
 
-    if file_extension == '.heic':
-         # Use pillow-heif for HEIC format
-        heif_image = pillow_heif.open_heif(file_path)
-        exif_data = heif_image.info.get('exif')
-        
-        if exif_data:
-            # Decode the EXIF bytes using piexif
-            exif_dict = piexif.load(exif_data)
+        segment_length = struct.unpack(">H", header[2:])[0] - 2
+        segment_start = file.tell()
+        yield marker, segment_length
+        file.seek(segment_start + segment_length)
+
+def read_jpeg_exif(file):
+    """Return the TIFF payload of the APP1/Exif segment, reading only the JPEG marker headers."""
+    for marker, segment_length in iter_jpeg_segments(file):
+        if marker == 0xE1 and segment_length > 6 and file.read(6) == b"Exif\x00\x00":
+            return file.read(min(segment_length - 6, MAX_EXIF_SIZE))
+    return None
+
+def iter_boxes(data, offset=0, end=None):
+    """Yield (box_type, body_start, box_end) for the ISO BMFF boxes in data[offset:end]."""
+    end = len(data) if end is None else end
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", data, offset)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", data, offset + 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size or offset + size > end:
+            return
+        yield box_type, offset + header_size, offset + size
+        offset += size
+
+def find_box(file, box_type, end=None):
+    """
+    Seek over ISO BMFF box headers from the current position until a box of box_type is found.
+    Leaves the file at the start of its body and returns the body size, or None if there is no such box before end.
+    """
+    while end is None or file.tell() + 8 <= end:
+        header = file.read(8)
+        if len(header) < 8:
+            return None
+        size, current_box_type = struct.unpack(">I4s", header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack(">Q", file.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            # the last box runs until the end of the file
+            size = os.fstat(file.fileno()).st_size - file.tell() + header_size
+        if size < header_size:
+            return None
+        if current_box_type == box_type:
+            return size - header_size
+        file.seek(size - header_size, os.SEEK_CUR)
+    return None
+
+def read_heif_meta_box(file):
+    """Return the body of the top-level 'meta' box, seeking over everything else (mdat in particular)."""
+    meta_size = find_box(file, b"meta")
+    if meta_size is None or meta_size > MAX_METADATA_BOX_SIZE:
+        return None
+    return file.read(meta_size)
+
+def read_heif_item_locations(meta):
+    """Parse the 'iinf' and 'iloc' boxes of a HEIF 'meta' box body into item types and file extents."""
+    item_types = {}
+    item_extents = {}
+
+    # meta is a full box, skip version and flags
+    for box_type, start, end in iter_boxes(meta, 4):
+        version = meta[start]
+
+        if box_type == b"iinf":
+            entries_start = start + (6 if version == 0 else 8)
+            for entry_type, entry_start, _ in iter_boxes(meta, entries_start, end):
+                if entry_type != b"infe" or meta[entry_start] < 2:
+                    continue
+                if meta[entry_start] == 2:
+                    item_id = struct.unpack_from(">H", meta, entry_start + 4)[0]
+                    type_offset = entry_start + 8
+                else:
+                    item_id = struct.unpack_from(">I", meta, entry_start + 4)[0]
+                    type_offset = entry_start + 10
+                item_types[item_id] = meta[type_offset:type_offset + 4]
+
+        elif box_type == b"iloc":
+            offset_size = meta[start + 4] >> 4
+            length_size = meta[start + 4] & 0x0F
+            base_offset_size = meta[start + 5] >> 4
+            index_size = meta[start + 5] & 0x0F if version in (1, 2) else 0
+            position = start + 6
+
+            def read_uint(size):
+                nonlocal position
+                value = int.from_bytes(meta[position:position + size], "big") if size else 0
+                position += size
+                return value
+
+            item_count = read_uint(2 if version < 2 else 4)
+            for _ in range(item_count):
+                item_id = read_uint(2 if version < 2 else 4)
+                construction_method = read_uint(2) & 0x0F if version in (1, 2) else 0
+                read_uint(2)  # data_reference_index
+                base_offset = read_uint(base_offset_size)
+                extents = []
+                for _ in range(read_uint(2)):
+                    read_uint(index_size)
+                    extents.append((base_offset + read_uint(offset_size), read_uint(length_size)))
+                # only items stored directly in the file are supported
+                if construction_method == 0:
+                    item_extents[item_id] = extents
+
+    return item_types, item_extents
+
+def read_heif_exif(file):
+    """Return the TIFF payload of the HEIF 'Exif' item without decoding any image data."""
+    meta = read_heif_meta_box(file)
+    if meta is None:
+        return None
+
+    item_types, item_extents = read_heif_item_locations(meta)
+    for item_id, item_type in item_types.items():
+        if item_type != b"Exif" or item_id not in item_extents:
+            continue
+        exif_data = b""
+        for extent_offset, extent_length in item_extents[item_id]:
+            file.seek(extent_offset)
+            exif_data += file.read(min(extent_length, MAX_EXIF_SIZE - len(exif_data)))
+        if len(exif_data) < 4:
+            return None
+        # the item starts with the offset to the TIFF header, usually skipping an "Exif\0\0" prefix
+        tiff_header_offset = struct.unpack(">I", exif_data[:4])[0]
+        return exif_data[4 + tiff_header_offset:]
+
+    return None
+
+def read_tiff_ifd(tiff, byte_order, ifd_offset):
+    """Read one TIFF IFD and return its entries as {tag: value} together with the next IFD offset."""
+    entries = {}
+    if ifd_offset <= 0 or ifd_offset + 2 > len(tiff):
+        return entries, 0
+
+    entry_count = struct.unpack_from(byte_order + "H", tiff, ifd_offset)[0]
+    for i in range(entry_count):
+        entry_offset = ifd_offset + 2 + i * 12
+        if entry_offset + 12 > len(tiff):
+            break
+        tag, field_type, count = struct.unpack_from(byte_order + "HHI", tiff, entry_offset)
+        if field_type not in TIFF_TYPES:
+            continue
+
+        value_format, value_size = TIFF_TYPES[field_type]
+        data_size = value_size * count
+        if data_size <= 4:
+            data_offset = entry_offset + 8
         else:
-            exif_dict = None
+            data_offset = struct.unpack_from(byte_order + "I", tiff, entry_offset + 8)[0]
+        if data_offset + data_size > len(tiff):
+            continue
 
-        exif_dict = extract_exif_data(exif_dict)
-    else:
-         # Use Pillow for other formats
-        image = Image.open(file_path)
-        exif_data = image._getexif()
-        exif_dict = {ExifTags.TAGS.get(tag): value for tag, value in exif_data.items()} if exif_data else None
+        if value_format == "s":
+            value = tiff[data_offset:data_offset + data_size]
+            if field_type == 2:
+                value = value.split(b"\x00")[0].decode(errors="replace").strip()
+        else:
+            value = struct.unpack_from(byte_order + value_format * count, tiff, data_offset)
+            if len(value_format) == 2:
+                value = tuple(zip(value[0::2], value[1::2]))
+        entries[tag] = value
+
+    next_offset_position = ifd_offset + 2 + entry_count * 12
+    next_ifd_offset = 0
+    if next_offset_position + 4 <= len(tiff):
+        next_ifd_offset = struct.unpack_from(byte_order + "I", tiff, next_offset_position)[0]
+    return entries, next_ifd_offset
+
+def parse_exif_tiff(tiff):
+    """Parse the TIFF structure of an EXIF block into the same {"0th", "Exif", "GPS", "1st"} layout piexif uses."""
+    if tiff is None or len(tiff) < 8 or tiff[:2] not in (b"II", b"MM"):
+        return None
 
-    # Convert EXIF data to a more readable dictionary format
+    byte_order = "<" if tiff[:2] == b"II" else ">"
+    ifd0_offset = struct.unpack_from(byte_order + "I", tiff, 4)[0]
+    ifd0, ifd1_offset = read_tiff_ifd(tiff, byte_order, ifd0_offset)
+
+    exif_dict = {"0th": ifd0, "Exif": {}, "GPS": {}, "1st": {}}
+    if 0x8769 in ifd0:
+        exif_dict["Exif"] = read_tiff_ifd(tiff, byte_order, ifd0[0x8769][0])[0]
+    if 0x8825 in ifd0:
+        exif_dict["GPS"] = read_tiff_ifd(tiff, byte_order, ifd0[0x8825][0])[0]
+    if ifd1_offset:
+        exif_dict["1st"] = read_tiff_ifd(tiff, byte_order, ifd1_offset)[0]
     return exif_dict
 
+def read_exif_tiff(file_path):
+    """Return the raw TIFF block of the EXIF data of a JPEG or HEIF file using only bounded header reads."""
+    file_extension = os.path.splitext(file_path)[1].lower()
+    with open(file_path, "rb") as file:
+        if file_extension in HEIF_EXTENSIONS:
+            return read_heif_exif(file)
+        return read_jpeg_exif(file)
+
+def read_exif_dict(file_path):
+    """Read and parse the EXIF block of a JPEG or HEIF file."""
+    return parse_exif_tiff(read_exif_tiff(file_path))
+
+def rational_to_float(value):
+    """Convert a (numerator, denominator) pair or a Pillow IFDRational to a float, treating x/0 as 0."""
+    if isinstance(value, tuple):
+        return float(Fraction(*value)) if value[1] else 0.0
+    return float(value)
+
+def gps_to_decimal(reference, dms):
+    """Convert a GPS reference and a (degrees, minutes, seconds) tuple to decimal degrees."""
+    d, m, s = [rational_to_float(value) for value in dms]
+    decimal = d + (m / 60.0) + (s / 3600.0)
+    return -decimal if reference in ('S', 'W') else decimal
+
 def extract_exif_data(exif_dict):
     result = {}
 
     # Extract the DateTime
-    if '0th' in exif_dict and 306 in exif_dict['0th']:
-        result['DateTime'] = exif_dict['0th'][306].decode() if isinstance(exif_dict['0th'][306], bytes) else exif_dict['0th'][306]
-    
+    if 306 in exif_dict['0th']:
+        result['DateTime'] = exif_dict['0th'][306]
+
+    # SubSecTime belongs to DateTime, SubSecTimeOriginal is used when a camera only writes that one
+    exif_data = exif_dict.get('Exif', {})
+    for subsec_tag in (37520, 37521):
+        if subsec_tag in exif_data:
+            subsec = re.sub(r"\D", "", str(exif_data[subsec_tag]))
+            if subsec:
+                result['SubSecTime'] = subsec
+                break
+
     # Extract GPS Data
     gps_info = {}
-    if 'GPS' in exif_dict:
-        gps_data = exif_dict['GPS']
-
-        # Latitude
-        if 1 in gps_data and 2 in gps_data:
-            latitude_ref = gps_data[1].decode() if isinstance(gps_data[1], bytes) else gps_data[1]
-            latitude = [float(Fraction(coord[0], coord[1])) for coord in gps_data[2]]
-            latitude = latitude[0] + latitude[1]/60 + latitude[2]/3600
-            gps_info['Latitude'] = latitude if latitude_ref == 'N' else -latitude
-        
-        # Longitude
-        if 3 in gps_data and 4 in gps_data:
-            longitude_ref = gps_data[3].decode() if isinstance(gps_data[3], bytes) else gps_data[3]
-            longitude = [float(Fraction(coord[0], coord[1])) for coord in gps_data[4]]
-            longitude = longitude[0] + longitude[1]/60 + longitude[2]/3600
-            gps_info['Longitude'] = longitude if longitude_ref == 'E' else -longitude
-
-        # Altitude
-        if 5 in gps_data and 6 in gps_data:
-            altitude = float(Fraction(gps_data[6][0], gps_data[6][1]))
-            gps_info['Altitude'] = altitude if gps_data[5] == 0 else -altitude
-    
+    gps_data = exif_dict['GPS']
+
+    # Latitude
+    if 1 in gps_data and 2 in gps_data:
+        gps_info['Latitude'] = gps_to_decimal(gps_data[1], gps_data[2])
+
+    # Longitude
+    if 3 in gps_data and 4 in gps_data:
+        gps_info['Longitude'] = gps_to_decimal(gps_data[3], gps_data[4])
+
+    # Altitude
+    if 5 in gps_data and 6 in gps_data:
+        altitude = rational_to_float(gps_data[6][0])
+        altitude_ref = gps_data[5][0] if isinstance(gps_data[5], (tuple, bytes)) else gps_data[5]
+        gps_info['Altitude'] = altitude if altitude_ref == 0 else -altitude
+
     # Include GPS info in the result if available
     if gps_info:
         result['GPS'] = gps_info
-    
-    return result
 
-def convert_to_degrees(value):
-    # Convert the tuple to degrees
-    d, m, s = value
-    return d + (m / 60.0) + (s / 3600.0)
+    return result
 
-def extract_lat_lon(gps_data):
-    # Extract latitude and longitude
-    lat = eval(gps_data['GPSLatitude'])
-    lon = eval(gps_data['GPSLongitude'])
-    
-    # Convert to decimal degrees
-    lat_decimal = convert_to_degrees(lat)
-    lon_decimal = convert_to_degrees(lon)
-    
-    # Apply the hemisphere correction
-    if gps_data['GPSLatitudeRef'] == 'S':
-        lat_decimal = -lat_decimal
-    if gps_data['GPSLongitudeRef'] == 'W':
-        lon_decimal = -lon_decimal
-    
-    return lat_decimal, lon_decimal
+def extract_exif(file_path):
+    """
+    Return {"DateTime": ..., "GPS": {"Latitude", "Longitude", "Altitude"}} for a file, or None if it has no EXIF.
+    JPEG and HEIC are read straight from the file headers, other formats go through Pillow's lazy EXIF loader.
+    """
+    with metrics.timed("exif"):
+        return read_file_exif(file_path)
 
-def extract_image_gps_info(image_path):
-    image = Image.open(image_path)
-    image.verify()
-    exif = image.getexif().get_ifd(0x8825)
+def read_file_exif(file_path):
+    file_extension = os.path.splitext(file_path)[1].lower()
 
-    geo_tagging_info = {}
-    if not exif:
-        raise ValueError("No EXIF metadata found")
+    if file_extension in JPEG_EXTENSIONS or file_extension in HEIF_EXTENSIONS:
+        exif_dict = read_exif_dict(file_path)
     else:
-        gps_keys = ['GPSVersionID', 'GPSLatitudeRef', 'GPSLatitude', 'GPSLongitudeRef', 'GPSLongitude',
-                    'GPSAltitudeRef', 'GPSAltitude', 'GPSTimeStamp', 'GPSSatellites', 'GPSStatus', 'GPSMeasureMode',
-                    'GPSDOP', 'GPSSpeedRef', 'GPSSpeed', 'GPSTrackRef', 'GPSTrack', 'GPSImgDirectionRef',
-                    'GPSImgDirection', 'GPSMapDatum', 'GPSDestLatitudeRef', 'GPSDestLatitude', 'GPSDestLongitudeRef',
-                    'GPSDestLongitude', 'GPSDestBearingRef', 'GPSDestBearing', 'GPSDestDistanceRef', 'GPSDestDistance',
-                    'GPSProcessingMethod', 'GPSAreaInformation', 'GPSDateStamp', 'GPSDifferential']
-
-        for k, v in exif.items():
-            try:
-                geo_tagging_info[gps_keys[k]] = str(v)
-            except IndexError:
-                pass
-        return extract_lat_lon(geo_tagging_info)
+        # Use Pillow for other formats, getexif only reads the metadata chunks
+        with Image.open(file_path) as image:
+            exif = image.getexif()
+            exif_dict = {"0th": dict(exif), "Exif": {}, "GPS": {}} if exif else None
+            if exif_dict:
+                exif_dict["Exif"] = dict(exif.get_ifd(0x8769))
+                gps_data = exif.get_ifd(0x8825)
+                exif_dict["GPS"] = {tag: (value,) if not isinstance(value, (tuple, str)) else value for tag, value in gps_data.items()}
+
+    if not exif_dict:
+        return None
+
+    # Convert EXIF data to a more readable dictionary format
+    return extract_exif_data(exif_dict)
 
 def get_data_from_geocode(geo_coords):
-    return reverse_geocode.get(geo_coords)
+    with metrics.timed("geocode"):
+        return reverse_geocode.get(geo_coords)
+
+class GeocodeCache:
+    """
+    LRU cache in front of reverse_geocode, keyed by coordinates rounded to `precision` decimals (3 is ~100m).
+    Photos from one trip share nearly the same location, so most lookups never reach the k-d tree,
+    and the misses of a whole batch are resolved with a single vectorized query. The cache is kept
+    as JSON in cache_path between runs.
+    """
+
+    def __init__(self, cache_path="", precision=3, max_entries=100000):
+        self.cache_path = cache_path
+        self.precision = precision
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path) as cache_file:
+                self.entries.update(json.load(cache_file))
+
+    def get_key(self, geo_coords):
+        return f"{round(geo_coords[0], self.precision)},{round(geo_coords[1], self.precision)}"
+
+    def lookup_batch(self, coordinates):
+        """Return the reverse_geocode result for every (latitude, longitude) pair, in the same order."""
+        keys = [self.get_key(geo_coords) for geo_coords in coordinates]
+
+        missing_keys = list(dict.fromkeys(key for key in keys if key not in self.entries))
+        if missing_keys:
+            # query the rounded coordinates so a cached result doesn't depend on which photo was seen first
+            query_coordinates = np.array([[float(part) for part in key.split(",")] for key in missing_keys])
+            with metrics.timed("geocode"):
+                geo_results = reverse_geocode.search(query_coordinates)
+            for key, geo_data in zip(missing_keys, geo_results):
+                self.entries[key] = dict(geo_data)
+
+        results = []
+        uncached_keys = set(missing_keys)
+        for key in keys:
+            # repeats of a missing location within the same batch were still answered by one query
+            if key in uncached_keys:
+                uncached_keys.discard(key)
+                self.misses += 1
+            else:
+                self.hits += 1
+            self.entries.move_to_end(key)
+            results.append(self.entries[key])
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+        return results
+
+    def save(self):
+        if not self.cache_path:
+            return
+        temporary_path = self.cache_path + ".tmp"
+        with open(temporary_path, "w") as cache_file:
+            json.dump(self.entries, cache_file)
+        os.replace(temporary_path, self.cache_path)
+
+    def print_stats(self):
+        lookups = self.hits + self.misses
+        if lookups:
+            log_event(logging.INFO, "Geocode cache: {lookups} lookups, {hits} hits, {misses} misses, "
+                      "hit rate {hit_rate:.1f}%, {cached} cached locations", lookups=lookups, hits=self.hits,
+                      misses=self.misses, hit_rate=100 * self.hits / lookups, cached=len(self.entries))
+
+def get_heif_thumbnail(heif_file):
+    """Decode the smallest embedded HEIF thumbnail that is still at least HASH_DECODE_SIZE, if there is one."""
+    try:
+        heif_image = heif_file[heif_file.primary_index]
+        thumbnail_sizes = heif_image.info.get("thumbnails") or []
+        usable_thumbnails = [(box_size, index) for index, box_size in enumerate(thumbnail_sizes) if box_size >= HASH_DECODE_SIZE]
+        if not usable_thumbnails:
+            return None
+        return heif_image.get_thumbnail(min(usable_thumbnails)[1]).to_pillow()
+    except (AttributeError, IndexError, TypeError):
+        # older pillow-heif versions don't expose thumbnails this way
+        return None
+
+def get_exif_thumbnail(image_path, image_size):
+    """Decode the JPEG thumbnail stored in IFD1 of the EXIF block, if it has the same aspect ratio as the image."""
+    tiff = read_exif_tiff(image_path)
+    exif_dict = parse_exif_tiff(tiff)
+    if not exif_dict or 0x0201 not in exif_dict["1st"] or 0x0202 not in exif_dict["1st"]:
+        return None
+
+    thumbnail_offset = exif_dict["1st"][0x0201][0]
+    thumbnail_length = exif_dict["1st"][0x0202][0]
+    thumbnail = Image.open(io.BytesIO(tiff[thumbnail_offset:thumbnail_offset + thumbnail_length]))
+    thumbnail.load()
+
+    # letterboxed thumbnails would shift the hash, so only use ones that match the image
+    if min(thumbnail.size) < HASH_MIN_THUMBNAIL_SIZE:
+        return None
+    if abs(thumbnail.width / thumbnail.height - image_size[0] / image_size[1]) > 0.02:
+        return None
+    return thumbnail
+
+def open_reduced_image(image_path):
+    """
+    Open an image at the lowest resolution that still gives a stable 8x8 average hash:
+    DCT-scaled decoding for JPEG, embedded thumbnails for HEIF and a full decode for everything else.
+    """
+    file_extension = os.path.splitext(image_path)[1].lower()
+
+    if file_extension in HEIF_EXTENSIONS:
+        heif_file = pillow_heif.open_heif(image_path)
+        thumbnail = get_heif_thumbnail(heif_file) or get_exif_thumbnail(image_path, heif_file.size)
+        if thumbnail is not None:
+            return thumbnail
+
+    image = Image.open(image_path)
+    if file_extension in JPEG_EXTENSIONS:
+        # let libjpeg scale down by up to 1/8 while decoding, only luminance is needed for the hash
+        image.draft("L", (HASH_DECODE_SIZE, HASH_DECODE_SIZE))
+    return image
 
-def get_image_hash(image_path):
+def get_image_hash(image_path, reduced=True):
     try:
-        with Image.open(image_path) as img:
+        with metrics.timed("decode"):
+            img = open_reduced_image(image_path) if reduced else Image.open(image_path)
+            try:
+                img.load()
+            except Exception:
+                img.close()
+                raise
+        with img, metrics.timed("hash"):
             return imagehash.average_hash(img)
     except Exception as e:
-        print(f"Error processing image {image_path}: {e}")
+        log_event(logging.WARNING, "Error processing image {path}: {error}", path=image_path, error=e)
         return None
 
-def check_if_duplicate_image(source_folder, image_name, hash_map):
-    # Path of the current image
-    image_path = os.path.join(source_folder, image_name)
+def get_file_digest(file_path, chunk_size=1024 * 1024):
+    """Return the SHA-256 of the file content, read in fixed size chunks."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def get_quick_digest(file_path, sample_size=64 * 1024):
+    """SHA-256 of the size and the first and last sample_size bytes, enough to recognise a file without reading all of it."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        digest.update(str(size).encode())
+        digest.update(file.read(sample_size))
+        if size > sample_size:
+            file.seek(max(size - sample_size, sample_size))
+            digest.update(file.read(sample_size))
+    return digest.hexdigest()
+
+def is_video_file(file_name):
+    return file_name.lower().endswith(VIDEO_EXTENSIONS)
+
+class HashIndex:
+    """
+    Persistent SQLite cache of perceptual and content hashes.
+    Rows are keyed by path and only trusted while size, mtime and inode still match,
+    so re-runs only hash files that are new or changed since the last run.
+    """
 
-    if image_name.lower().endswith(('.mp3', '.mp4', '.mov')):
-        if is_duplicate_name(image_name):
-            return {"duplicate": True, "image_name": image_name, "image_hash": "video_"+image_name}
-        else:
-            return {"duplicate": False, "image_name": image_name, "image_hash": "video_"+image_name}
-        
-    # Get image hash
-    image_hash = get_image_hash(image_path)
-    
-    if image_hash is not None:
-        # Check if the name pattern indicates a duplicate
-        if is_duplicate_name(image_name):
-            return {"duplicate": True, "image_name": image_name, "image_hash": str(image_hash)}
-
-        # Check if the hash already exists in the hash_map
-        hash_key = str(image_hash)
-        if hash_key in hash_map:
-            for original_name in hash_map[hash_key]:
-                return {"duplicate": True, "image_name": image_name, "image_hash": str(image_hash)}
-        else:
-            return {"duplicate": False, "image_name": image_name, "image_hash": str(image_hash)}
-    else:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            inode INTEGER NOT NULL,
+            average_hash TEXT,
+            sha256 TEXT NOT NULL,
+            broken INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS files_average_hash ON files (average_hash);
+        CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256);
+        CREATE TABLE IF NOT EXISTS video_fingerprints (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            inode INTEGER NOT NULL,
+            duration REAL NOT NULL,
+            frame_hashes TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, db_path, commit_every=500):
+        self.connection = sqlite3.connect(db_path)
+        self.connection.executescript(self.SCHEMA)
+        self.commit_every = commit_every
+        self.pending_writes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def get_hashes(self, file_path, file_stat=None):
+        """
+        Return (average_hash, sha256, broken) for a file, hashing it only if the cached row is missing or stale.
+        average_hash is the hex string of imagehash.average_hash, or None for videos and broken images.
+        broken marks images that couldn't be decoded, they aren't decoded again until the file changes.
+        """
+        file_path = os.path.abspath(file_path)
+        file_stat = file_stat or os.stat(file_path)
+
+        row = self.connection.execute(
+            "SELECT size, mtime_ns, inode, average_hash, sha256, broken FROM files WHERE path = ?", (file_path,)
+        ).fetchone()
+        if row and row[:3] == (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino):
+            return row[3], row[4], bool(row[5])
+
+        average_hash = None
+        broken = False
+        if not is_video_file(file_path):
+            image_hash = get_image_hash(file_path)
+            average_hash = str(image_hash) if image_hash is not None else None
+            broken = image_hash is None
+        sha256 = get_file_digest(file_path)
+
+        # an upsert keeps the rowid of a changed file, it is the file id HashStore entries refer to
+        self.connection.execute(
+            "INSERT INTO files (path, size, mtime_ns, inode, average_hash, sha256, broken) VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (path) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns, inode = excluded.inode, "
+            "average_hash = excluded.average_hash, sha256 = excluded.sha256, broken = excluded.broken",
+            (file_path, file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino, average_hash, sha256, int(broken)),
+        )
+        self.pending_writes += 1
+        if self.pending_writes >= self.commit_every:
+            self.connection.commit()
+            self.pending_writes = 0
+
+        return average_hash, sha256, broken
+
+    def get_video_fingerprint(self, video_path):
+        """Return the cached (duration, [frame hashes]) of a video, or None if it is missing or stale."""
+        video_path = os.path.abspath(video_path)
+        file_stat = os.stat(video_path)
+        row = self.connection.execute(
+            "SELECT size, mtime_ns, inode, duration, frame_hashes FROM video_fingerprints WHERE path = ?", (video_path,)
+        ).fetchone()
+        if row and row[:3] == (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino):
+            return row[3], [int(frame_hash, 16) for frame_hash in row[4].split(",")]
         return None
 
+    def set_video_fingerprint(self, video_path, fingerprint):
+        video_path = os.path.abspath(video_path)
+        file_stat = os.stat(video_path)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO video_fingerprints (path, size, mtime_ns, inode, duration, frame_hashes) VALUES (?, ?, ?, ?, ?, ?)",
+            (video_path, file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino, fingerprint[0],
+             ",".join(f"{frame_hash:016x}" for frame_hash in fingerprint[1])),
+        )
+
+    def index_folder(self, folder):
+        """Hash every file below folder (recursively) and drop rows of files that no longer exist there."""
+        folder = os.path.abspath(folder)
+        seen_paths = set()
+        for _, entry in scan_files(folder, recursive=True):
+            self.get_hashes(entry.path, entry.stat())
+            seen_paths.add(entry.path)
+
+        for _, file_path, _, _ in self.get_folder_hashes(folder):
+            if file_path not in seen_paths:
+                self.connection.execute("DELETE FROM files WHERE path = ?", (file_path,))
+        self.connection.commit()
+
+    def get_folder_hashes(self, folder):
+        """Return (file id, path, average_hash, sha256) rows of every indexed file below folder."""
+        folder_prefix = os.path.join(os.path.abspath(folder), "")
+        return self.connection.execute(
+            "SELECT rowid, path, average_hash, sha256 FROM files WHERE substr(path, 1, length(?)) = ?", (folder_prefix, folder_prefix)
+        ).fetchall()
+
+    def find_digest(self, sha256, folder):
+        """Return the path of an indexed file below folder with this content digest, or None."""
+        folder_prefix = os.path.join(os.path.abspath(folder), "")
+        row = self.connection.execute(
+            "SELECT path FROM files WHERE sha256 = ? AND substr(path, 1, length(?)) = ? LIMIT 1", (sha256, folder_prefix, folder_prefix)
+        ).fetchone()
+        return row[0] if row else None
+
+    def get_file_id(self, file_path):
+        row = self.connection.execute("SELECT rowid FROM files WHERE path = ?", (os.path.abspath(file_path),)).fetchone()
+        return row[0] if row else -1
+
+    def get_path(self, file_id):
+        row = self.connection.execute("SELECT path FROM files WHERE rowid = ?", (file_id,)).fetchone()
+        return row[0] if row else None
+
+class FileManifest:
+    """
+    Persistent SQLite record of every source file that went through metadata extraction, with the result:
+    its action ("place", "unsorted" or "error"), new name, date, time, GPS and country.
+    Rows are found by path while size and mtime still match, or by size and a quick content digest
+    when the same file shows up under another path, e.g. a card mounted somewhere else.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS manifest (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            digest TEXT NOT NULL,
+            action TEXT NOT NULL,
+            new_name TEXT,
+            date TEXT,
+            time TEXT,
+            latitude REAL,
+            longitude REAL,
+            country TEXT,
+            error TEXT,
+            subsec TEXT
+        );
+        CREATE INDEX IF NOT EXISTS manifest_digest ON manifest (size, digest);
+    """
+    FIELDS = ("action", "new_name", "date", "time", "latitude", "longitude", "country", "error", "subsec")
+
+    def __init__(self, db_path, commit_every=500):
+        self.connection = sqlite3.connect(db_path)
+        self.connection.executescript(self.SCHEMA)
+        self.commit_every = commit_every
+        self.pending_writes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def get_metadata(self, file_path, file_name, file_stat=None):
+        """
+        Return (metadata, digest): the metadata recorded for the file in its current state as extract_file_metadata
+        would return it, or None, and the quick digest if the lookup had to compute it, to be passed on to record.
+        """
+        file_path = os.path.abspath(file_path)
+        file_stat = file_stat or os.stat(file_path)
+        columns = ", ".join(self.FIELDS)
+
+        row = self.connection.execute(
+            f"SELECT size, mtime_ns, {columns} FROM manifest WHERE path = ?", (file_path,)
+        ).fetchone()
+        digest = None
+        if row and row[:2] == (file_stat.st_size, file_stat.st_mtime_ns):
+            values = row[2:]
+        else:
+            digest = get_quick_digest(file_path)
+            row = self.connection.execute(
+                f"SELECT {columns} FROM manifest WHERE size = ? AND digest = ?", (file_stat.st_size, digest)
+            ).fetchone()
+            if row is None:
+                return None, digest
+            values = row
+
+        record = dict(zip(self.FIELDS, values))
+        gps = (record.pop("latitude"), record.pop("longitude"))
+        return {"file_name": file_name, "gps": gps if gps[0] is not None else None, "country": record.pop("country") or "", **record}, digest
+
+    def record(self, file_path, metadata, file_stat=None, digest=None):
+        """Record the metadata of a file, digest is the quick digest get_metadata already computed for it, if any."""
+        file_path = os.path.abspath(file_path)
+        file_stat = file_stat or os.stat(file_path)
+        gps = metadata["gps"] or (None, None)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO manifest (path, size, mtime_ns, digest, action, new_name, date, time, latitude, longitude, country, error, subsec) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (file_path, file_stat.st_size, file_stat.st_mtime_ns, digest or get_quick_digest(file_path), metadata["action"], metadata["new_name"],
+             metadata["date"], metadata["time"], gps[0], gps[1], metadata["country"], metadata["error"], metadata["subsec"]),
+        )
+        self.pending_writes += 1
+        if self.pending_writes >= self.commit_every:
+            self.connection.commit()
+            self.pending_writes = 0
+
+def hamming_distance(first_hash, second_hash):
+    return bin(first_hash ^ second_hash).count("1")
+
 def is_duplicate_name(file_name):
     """
     Check if the current image name indicates a duplicate based on the naming pattern:
@@ -178,152 +944,960 @@ def is_duplicate_name(file_name):
     if re.search(r" \(\d+\)\.", file_name):
         return True
 
-def verify_duplicates(duplicates_list, hash_map):
-    hash_not_found = []
-    for key, value in duplicates_list.items():
-        key_to_compare = value
-        if ("video_" in value):
-            file_type = value.split(".")[1]
-            video_hash = value.split(" ")[0]
-            key_to_compare = video_hash + "." + file_type
-        if key_to_compare in hash_map:
-            continue
+def copy_file_data(source, destination, chunk_size=1024 * 1024):
+    """
+    Copy the content of source into destination without passing it through Python where the OS allows it:
+    copy_file_range (in-kernel, server side on NFS/SMB, reflinks on CoW filesystems), then sendfile,
+    then a plain buffered copy for whatever is left. Returns the number of bytes copied.
+    """
+    with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+        source_fd = source_file.fileno()
+        destination_fd = destination_file.fileno()
+        size = os.fstat(source_fd).st_size
+        offset = 0
+
+        if hasattr(os, "copy_file_range"):
+            try:
+                while offset < size:
+                    copied = os.copy_file_range(source_fd, destination_fd, size - offset, offset, offset)
+                    if copied == 0:
+                        break
+                    offset += copied
+            except OSError as e:
+                # not supported between these filesystems, carry on with the next method
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF):
+                    raise
+
+        if offset < size and hasattr(os, "sendfile"):
+            try:
+                while offset < size:
+                    os.lseek(destination_fd, offset, os.SEEK_SET)
+                    sent = os.sendfile(destination_fd, source_fd, offset, min(size - offset, 1 << 30))
+                    if sent == 0:
+                        break
+                    offset += sent
+            except OSError as e:
+                if e.errno not in (errno.ENOSYS, errno.EINVAL, errno.ENOTSOCK, errno.EOPNOTSUPP):
+                    raise
+
+        if offset < size:
+            source_file.seek(offset)
+            destination_file.seek(offset)
+            shutil.copyfileobj(source_file, destination_file, chunk_size)
+            offset = destination_file.tell()
+        return offset
+
+class TransferEngine:
+    """
+    Moves and copies files. Outside of batch() every transfer happens right away, inside a batch transfers are
+    queued and run concurrently on an asyncio loop, with at most per_device_limit transfers touching a device.
+    - same device: a rename
+    - different devices: copy_file_data into a .part file, optionally verified by SHA-256, renamed into place,
+      and for a move the source is removed only after that
+    Queued transfers already count as done for exists(), so callers keep deciding while the batch is pending.
+    """
+
+    def __init__(self, per_device_limit=4, verify=False, queue_limit=256):
+        self.per_device_limit = per_device_limit
+        self.verify = verify
+        self.queue_limit = queue_limit
+        self.batch_depth = 0
+        self.pending = [] # (source, destination, move)
+        self.pending_sources = set()
+        self.pending_destinations = set()
+
+    @contextmanager
+    def batch(self):
+        self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            self.batch_depth -= 1
+            if self.batch_depth == 0:
+                self.flush()
+
+    def exists(self, path):
+        if path in self.pending_destinations:
+            return True
+        if path in self.pending_sources:
+            return False
+        return os.path.exists(path)
+
+    def wait_for(self, path):
+        """Finish the queued transfers if path takes part in one, before the caller touches it directly."""
+        if path in self.pending_sources or path in self.pending_destinations:
+            self.flush()
+
+    def submit(self, source, destination, move=True):
+        # a transfer that depends on a queued one has to wait for it
+        if (source in self.pending_sources or source in self.pending_destinations
+                or destination in self.pending_sources or destination in self.pending_destinations):
+            self.flush()
+        self.pending.append((source, destination, move))
+        if move:
+            self.pending_sources.add(source)
+        self.pending_destinations.add(destination)
+        if self.batch_depth == 0 or len(self.pending) >= self.queue_limit:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        transfers = self.pending
+        self.pending = []
+        self.pending_sources = set()
+        self.pending_destinations = set()
+        if len(transfers) == 1:
+            self.run_transfer(*transfers[0])
         else:
-            hash_not_found.append(key)
+            asyncio.run(self.run_transfers(transfers))
 
-    for k in hash_not_found:
-        del duplicates_list[k]
-        
+    async def run_transfers(self, transfers):
+        device_semaphores = defaultdict(lambda: asyncio.Semaphore(self.per_device_limit))
 
-    return duplicates_list, hash_not_found
+        async def run_limited(source, destination, move):
+            try:
+                devices = await asyncio.to_thread(get_transfer_devices, source, destination)
+            except OSError:
+                devices = []
+            async with AsyncExitStack() as stack:
+                # semaphores are always taken in device order, so two transfers can't wait on each other
+                for device in devices:
+                    await stack.enter_async_context(device_semaphores[device])
+                await asyncio.to_thread(self.run_transfer, source, destination, move)
+
+        await asyncio.gather(*(run_limited(*transfer) for transfer in transfers))
+
+    def run_transfer(self, source, destination, move=True):
+        try:
+            with metrics.timed("move" if move else "copy"):
+                self.transfer(source, destination, move)
+            metrics.count("files_moved" if move else "files_copied")
+            log_event(logging.DEBUG, "{action} file: {source} to {destination}", action="Moved" if move else "Copied",
+                      source=source, destination=destination)
+        except Exception as e:
+            metrics.count("transfer_errors")
+            log_event(logging.ERROR, "Error transferring {source} to {destination}: {error}", source=source, destination=destination, error=e)
+
+    def transfer(self, source, destination, move=True):
+        if move:
+            try:
+                os.rename(source, destination)
+                return
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
 
-def move_file_to_folder(source: str, destination: str):
-    """Move a file from the source path to the destination path."""
+        temporary_path = destination + ".part"
+        try:
+            metrics.count("bytes_copied", copy_file_data(source, temporary_path))
+            shutil.copystat(source, temporary_path)
+            if self.verify and get_file_digest(source) != get_file_digest(temporary_path):
+                raise OSError(f"Checksum mismatch after copying {source}")
+            os.replace(temporary_path, destination)
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+        if move:
+            os.remove(source)
+
+def get_transfer_devices(source, destination):
+    """Sorted st_dev of the source file and of the destination folder."""
+    return sorted({os.stat(source).st_dev, os.stat(os.path.dirname(destination) or ".").st_dev})
+
+transfer_engine = TransferEngine()
+
+def allocate_free_name(file_name, is_name_free, subsec=""):
+    """
+    Return file_name if is_name_free accepts it, else with the _{subsec} sub-second time if there is one,
+    else with the first accepted -{sequence} suffix. Every name given to a placed or set aside file comes from here.
+    """
+    if is_name_free(file_name):
+        return file_name
+    file_stem, file_extension = os.path.splitext(file_name)
+    if subsec:
+        file_stem += "_" + subsec
+        if is_name_free(file_stem + file_extension):
+            return file_stem + file_extension
+    sequence = 2
+    while not is_name_free(f"{file_stem}-{sequence}{file_extension}"):
+        sequence += 1
+    return f"{file_stem}-{sequence}{file_extension}"
+
+class FolderListing:
+    """
+    Names of the files in target folders, grouped by stem. Inside scope() each folder is listed once with
+    os.scandir and then kept up to date as planned moves add and remove names, instead of an os.path.exists
+    call per candidate name. Outside of a scope every lookup lists the folder again.
+    """
+
+    def __init__(self):
+        self.scope_depth = 0
+        self.folders = {} # folder -> {stem: set of file names}
+
+    @contextmanager
+    def scope(self):
+        self.scope_depth += 1
+        try:
+            yield self
+        finally:
+            self.scope_depth -= 1
+            if self.scope_depth == 0:
+                self.folders.clear()
+
+    def get_stems(self, folder):
+        stems = self.folders.get(folder)
+        if stems is not None:
+            return stems
+
+        stems = defaultdict(set)
+        if os.path.isdir(folder):
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        stems[os.path.splitext(entry.name)[0]].add(entry.name)
+        # transfers still queued already count as done
+        for destination in transfer_engine.pending_destinations:
+            if os.path.dirname(destination) == folder:
+                stems[os.path.splitext(os.path.basename(destination))[0]].add(os.path.basename(destination))
+        for source in transfer_engine.pending_sources:
+            if os.path.dirname(source) == folder:
+                stems[os.path.splitext(os.path.basename(source))[0]].discard(os.path.basename(source))
+        if self.scope_depth:
+            self.folders[folder] = stems
+        return stems
+
+    def get_names(self, folder, stem):
+        return self.get_stems(folder).get(stem, set())
+
+    def allocate(self, folder, file_name, whole_stem=False):
+        """
+        Return file_name, or with the first -{sequence} suffix that isn't taken in folder, and take it.
+        With whole_stem a name is taken while any file has its stem, whatever the extension.
+        """
+        def is_name_free(name):
+            names = self.get_names(folder, os.path.splitext(name)[0])
+            return not names if whole_stem else name not in names
+
+        file_name = allocate_free_name(file_name, is_name_free)
+        self.add(folder, file_name)
+        return file_name
+
+    def add(self, folder, file_name):
+        if folder in self.folders:
+            self.folders[folder][os.path.splitext(file_name)[0]].add(file_name)
+
+    def remove(self, folder, file_name):
+        if folder in self.folders:
+            self.folders[folder][os.path.splitext(file_name)[0]].discard(file_name)
+
+    def forget(self, folder):
+        self.folders.pop(folder, None)
+
+folder_listing = FolderListing()
+
+def read_jpeg_frame_info(file):
+    """Return (width, height, bits per sample) from the JPEG start-of-frame segment, or None."""
+    for marker, segment_length in iter_jpeg_segments(file):
+        if marker in JPEG_SOF_MARKERS and segment_length >= 5:
+            precision, height, width = struct.unpack(">BHH", file.read(5))
+            return width, height, precision
+    return None
+
+def read_heif_image_info(file):
+    """Return (width, height, bits per channel) of the largest image in the HEIF item properties, or None."""
+    meta = read_heif_meta_box(file)
+    if meta is None:
+        return None
+
+    width = height = bit_depth = 0
+    for box_type, start, end in iter_boxes(meta, 4):
+        if box_type != b"iprp":
+            continue
+        for container_type, container_start, container_end in iter_boxes(meta, start, end):
+            if container_type != b"ipco":
+                continue
+            for property_type, property_start, property_end in iter_boxes(meta, container_start, container_end):
+                # both are full boxes, the values start after version and flags
+                if property_type == b"ispe" and property_end - property_start >= 12:
+                    # the primary image (or its grid) is the largest, tiles and thumbnails are smaller
+                    image_width, image_height = struct.unpack_from(">II", meta, property_start + 4)
+                    if image_width * image_height > width * height:
+                        width, height = image_width, image_height
+                elif property_type == b"pixi" and property_end - property_start >= 5:
+                    channel_count = meta[property_start + 4]
+                    bit_depth = max([bit_depth] + list(meta[property_start + 5:property_start + 5 + channel_count]))
+    return (width, height, bit_depth) if width else None
+
+def get_media_quality(file_path):
+    """
+    Rank of a file among variants of the same picture, higher is better: (pixels, bits per sample, format, size).
+    Resolution and bit depth come from the JPEG frame header or the HEIF item properties, unknown values count as 0.
+    """
+    file_extension = os.path.splitext(file_path)[1].lower()
+    image_info = None
+    try:
+        with open(file_path, "rb") as file:
+            if file_extension in JPEG_EXTENSIONS:
+                image_info = read_jpeg_frame_info(file)
+            elif file_extension in HEIF_EXTENSIONS:
+                image_info = read_heif_image_info(file)
+        file_size = os.path.getsize(file_path)
+    except (OSError, struct.error, IndexError):
+        file_size = 0
+    width, height, bit_depth = image_info or (0, 0, 0)
+    format_priority = QUALITY_PRIORITY.index(file_extension) + 1 if file_extension in QUALITY_PRIORITY else 0
+    return width * height, bit_depth, format_priority, file_size
+
+def get_file_identity(file_path):
+    """
+    What LibraryIndex tells placed files apart by: {"size", "digest"} with the quick digest, and for pictures
+    with one of QUALITY_PRIORITY's extensions the EXIF "subsec" time and the frame "dimensions", None if unknown.
+    Returns None if the file can't be read.
+    """
+    file_extension = os.path.splitext(file_path)[1].lower()
     try:
-        shutil.move(source, destination)
-        print(f"Moved file: {source} to {destination}")
+        identity = {"size": os.path.getsize(file_path), "digest": get_quick_digest(file_path), "subsec": None, "dimensions": None}
+    except OSError:
+        return None
+    if file_extension in QUALITY_PRIORITY:
+        try:
+            image_data = read_file_exif(file_path)
+            identity["subsec"] = image_data.get("SubSecTime") if image_data else None
+            with open(file_path, "rb") as file:
+                image_info = read_jpeg_frame_info(file) if file_extension in JPEG_EXTENSIONS else read_heif_image_info(file)
+            identity["dimensions"] = image_info[:2] if image_info else None
+        except (OSError, struct.error, IndexError, ValueError):
+            pass
+    return identity
+
+def plan_duplicate_resolution(transfers, duplicate_folder=""):
+    """
+    Decide for a batch of (source path, target folder, file name) moves which file ends up with each name.
+    A file whose name is taken, or whose stem is taken by another of QUALITY_PRIORITY's extensions, is compared
+    with those files by get_media_quality if they are the same picture by perceptual hash, or the same file by
+    size and quick digest. The better one keeps the place, ties go to the file already there. When a different
+    file has the name, the new file gets a free -{sequence} name instead and nothing is ranked.
+    The other goes to the duplicate folder, with a -{sequence} suffix if its name is taken there already.
+    Without one, a losing new file stays where it is and a losing variant with another extension is removed.
+    Returns {"op": "move", "source", "destination"} and {"op": "remove", "path"} operations in the order they run.
+    """
+    operations = []
+    planned_sources = {} # planned destination -> where that file is until the plan has been applied
+    qualities = {}
+    fingerprints = {}
+
+    def get_quality(file_path):
+        file_path = planned_sources.get(file_path, file_path)
+        if file_path not in qualities:
+            qualities[file_path] = get_media_quality(file_path)
+        return qualities[file_path]
+
+    def get_fingerprint(file_path):
+        file_path = planned_sources.get(file_path, file_path)
+        if file_path not in fingerprints:
+            if os.path.splitext(file_path)[1].lower() in QUALITY_PRIORITY:
+                fingerprints[file_path] = get_image_hash(file_path)
+            else:
+                fingerprints[file_path] = (os.path.getsize(file_path), get_quick_digest(file_path))
+        return fingerprints[file_path]
+
+    def is_same_content(first_path, second_path):
+        first_fingerprint, second_fingerprint = get_fingerprint(first_path), get_fingerprint(second_path)
+        if first_fingerprint is None or second_fingerprint is None:
+            return False
+        if isinstance(first_fingerprint, tuple):
+            return first_fingerprint == second_fingerprint
+        return first_fingerprint - second_fingerprint <= VARIANT_HAMMING_THRESHOLD
+
+    # names taken by earlier files of the plan have to be seen by later ones, so the listings are kept for the whole plan
+    with folder_listing.scope():
+        for source_path, target_folder, file_name in transfers:
+            file_base, file_extension = os.path.splitext(file_name)
+            existing_names = folder_listing.get_names(target_folder, file_base)
+            if file_extension.lower() in QUALITY_PRIORITY:
+                existing_names = [name for name in existing_names if os.path.splitext(name)[1].lower() in QUALITY_PRIORITY]
+            else:
+                existing_names = [name for name in existing_names if name == file_name]
+
+            existing_paths = [os.path.join(target_folder, name) for name in sorted(existing_names)]
+            matching_paths = [existing_path for existing_path in existing_paths if is_same_content(source_path, existing_path)]
+            taken_path = os.path.join(target_folder, file_name)
+            if existing_paths and (not matching_paths or (taken_path in existing_paths and taken_path not in matching_paths)):
+                # another picture has the name, nothing is replaced or removed for it
+                file_name = folder_listing.allocate(target_folder, file_name, whole_stem=file_extension.lower() in QUALITY_PRIORITY)
+                log_event(logging.DEBUG, "{existing} is a different file than {new}, which is named {file_name}.",
+                          existing=existing_paths[0], new=source_path, file_name=file_name)
+                metrics.count("name_collisions")
+                existing_paths = []
+            else:
+                existing_paths = matching_paths
+
+            if existing_paths:
+                metrics.count("duplicates_resolved")
+                new_quality = get_quality(source_path)
+                if any(get_quality(existing_path) >= new_quality for existing_path in existing_paths):
+                    if duplicate_folder:
+                        duplicate_name = folder_listing.allocate(duplicate_folder, file_name)
+                        operations.append({"op": "move", "source": source_path, "destination": os.path.join(duplicate_folder, duplicate_name)})
+                    log_event(logging.DEBUG, "Higher quality file {existing} already exists in {folder}, {action} {new}.",
+                              existing=existing_paths[0], folder=target_folder, new=source_path,
+                              action="moving to the duplicate folder" if duplicate_folder else "skipping")
+                    continue
+                if not duplicate_folder and taken_path in existing_paths:
+                    log_event(logging.WARNING, "File {file_name} already exists in {folder}.", file_name=file_name, folder=target_folder)
+                    continue
+
+                for existing_path in existing_paths:
+                    existing_name = os.path.basename(existing_path)
+                    folder_listing.remove(target_folder, existing_name)
+                    if duplicate_folder:
+                        duplicate_name = folder_listing.allocate(duplicate_folder, existing_name)
+                        operations.append({"op": "move", "source": existing_path, "destination": os.path.join(duplicate_folder, duplicate_name)})
+                    else:
+                        operations.append({"op": "remove", "path": existing_path})
+                    log_event(logging.DEBUG, "Existing file {existing} is lower quality than {new}.", existing=existing_path, new=source_path)
+
+            destination_path = os.path.join(target_folder, file_name)
+            operations.append({"op": "move", "source": source_path, "destination": destination_path})
+            folder_listing.add(target_folder, file_name)
+            planned_sources[destination_path] = source_path
+
+    return operations
+
+def apply_resolution_plan(operations):
+    """Queue the operations from plan_duplicate_resolution on the transfer engine, an error only stops its own operation."""
+    for operation in operations:
+        if operation["op"] == "move":
+            transfer_engine.submit(operation["source"], operation["destination"])
+        elif operation["op"] == "remove":
+            try:
+                transfer_engine.wait_for(operation["path"])
+                os.remove(operation["path"])
+                log_event(logging.DEBUG, "Removed lower quality file {path}", path=operation["path"])
+            except Exception as e:
+                metrics.count("operation_errors")
+                log_event(logging.ERROR, "Error removing {path}: {error}", path=operation["path"], error=e)
+
+def move_files(source_folder: str, file_names: List[str], target_folder: str, duplicate_folder: str = ""):
+    """Move files from source to target folder, handling duplicates based on file quality, as one batched plan."""
+    # file names can be relative paths from a recursive scan, the target folder is always flat
+    transfers = [(os.path.join(source_folder, file_name), target_folder, os.path.basename(file_name)) for file_name in file_names]
+    with transfer_engine.batch(), folder_listing.scope():
+        apply_resolution_plan(plan_duplicate_resolution(transfers, duplicate_folder))
+
+def copy_files(source_folder, file_names, target_folder):
+    with transfer_engine.batch():
+        for file_name in file_names:
+            file_path = os.path.join(source_folder, file_name)
+            destination_path = os.path.join(target_folder, file_name)
+
+            if transfer_engine.exists(destination_path):
+                log_event(logging.DEBUG, "File {file_name} already exists in {destination}. Skipping...", file_name=file_name, destination=destination_path)
+                continue
+
+            transfer_engine.submit(file_path, destination_path, move=False)
+
+def get_media_duration(video_path):
+    """Duration in seconds, read from the mvhd atom where possible and from ffprobe otherwise."""
+    if os.path.splitext(video_path)[1].lower() in MP4_EXTENSIONS:
+        movie_header = read_mp4_movie_header(video_path)
+        if movie_header is not None and movie_header[1] > 0:
+            return movie_header[1]
+    probe = ffmpeg.probe(video_path)
+    return float(probe['format']['duration'])
+
+def get_video_frame_hash(video_path, timestamp):
+    """Average hash of the frame at timestamp, decoded by ffmpeg and scaled down to 8x8 grayscale pixels."""
+    frame, _ = (
+        ffmpeg.input(video_path, ss=timestamp)
+        .filter("scale", 8, 8, flags="area")
+        .output("pipe:", vframes=1, format="rawvideo", pix_fmt="gray")
+        .run(capture_stdout=True, capture_stderr=True)
+    )
+    if len(frame) < 64:
+        return None
+    pixels = frame[:64]
+    mean = sum(pixels) / 64
+    hash_value = 0
+    for pixel in pixels:
+        hash_value = (hash_value << 1) | (pixel > mean)
+    return hash_value
+
+def get_video_fingerprint(video_path):
+    """
+    Return (duration, [frame hashes]) sampled at evenly spaced points of the clip, or None if it can't be decoded.
+    The samples are placed by time rather than on keyframes, so re-encodes with a different GOP layout still line up.
+    """
+    with metrics.timed("video_fingerprint"):
+        return compute_video_fingerprint(video_path)
+
+def compute_video_fingerprint(video_path):
+    try:
+        duration = get_media_duration(video_path)
+        frame_hashes = []
+        for i in range(VIDEO_FINGERPRINT_FRAMES):
+            frame_hash = get_video_frame_hash(video_path, duration * (i + 1) / (VIDEO_FINGERPRINT_FRAMES + 1))
+            if frame_hash is None:
+                return None
+            frame_hashes.append(frame_hash)
+        return duration, frame_hashes
     except Exception as e:
-        print(f"Error moving {source} to {destination}: {e}")
+        log_event(logging.WARNING, "Error fingerprinting video {path}: {error}", path=video_path, error=e)
+        return None
 
-def handle_existing_file(existing_file: str, new_file: str, duplicate_folder: str, target_folder: str, existing_is_higher_quality: bool):
-    """Handle cases where a file with the same name but different extension exists."""
-    existing_file_name = os.path.basename(existing_file)  # Extract just the file name
+def fingerprints_match(first_fingerprint, second_fingerprint, max_distance=VIDEO_FRAME_HAMMING_THRESHOLD):
+    if abs(first_fingerprint[0] - second_fingerprint[0]) > VIDEO_DURATION_TOLERANCE:
+        return False
+    # stop at the first sampled frame that differs
+    return all(hamming_distance(first, second) <= max_distance for first, second in zip(first_fingerprint[1], second_fingerprint[1]))
 
-    if existing_is_higher_quality:
-        if duplicate_folder:
-            duplicate_path = os.path.join(duplicate_folder, os.path.basename(new_file))
-            move_file_to_folder(new_file, duplicate_path)
-            print(f"Higher quality file {existing_file} already exists in {target_folder}. Copying to {duplicate_path}.")
-            return True
-        print(f"Higher quality file {existing_file} already exists in {target_folder}. Skipping {new_file}.")
-        return True
-    else:
-        if duplicate_folder:
-            duplicate_path = os.path.join(duplicate_folder, existing_file_name)
-            print(f"Existing folder {duplicate_path}")
-            move_file_to_folder(existing_file, duplicate_path)
-            print(f"Existing file {existing_file} is lower quality in {target_folder}. Moving it to: {duplicate_path}.")
+def fingerprint_videos(video_paths, workers=1, hash_index=None):
+    """
+    Return {path: fingerprint} for a batch of videos. Fingerprints cached in the hash index are reused,
+    the rest are computed concurrently, each ffmpeg decode runs in its own process.
+    """
+    fingerprints = {}
+    missing_paths = []
+    for video_path in video_paths:
+        cached_fingerprint = hash_index.get_video_fingerprint(video_path) if hash_index is not None else None
+        if cached_fingerprint is not None:
+            fingerprints[video_path] = cached_fingerprint
         else:
-            os.remove(existing_file)
-        return False
+            missing_paths.append(video_path)
 
-def move_files(source_folder: str, file_names: List[str], target_folder: str, duplicate_folder: str = ""):
-    """Move files from source to target folder, handling duplicates based on file quality."""
-    quality_priority = ['.heic', '.jpeg', '.jpg']
-
-    for file_name in file_names:
-        file_base, file_ext = os.path.splitext(file_name)
-        file_ext = file_ext.lower()
-
-        source_path = os.path.join(source_folder, file_name)
-        destination_path = os.path.join(target_folder, file_name)
-
-        moved_to_duplicate = False
-
-        # Check for existing files with different extensions in the target folder
-        for ext in quality_priority:
-            if ext != file_ext:
-                alt_file_name = f"{file_base}{ext}"
-                alt_file_path = os.path.join(target_folder, alt_file_name)
-
-                if os.path.exists(alt_file_path):
-                    is_higher_quality = quality_priority.index(file_ext) > quality_priority.index(ext)
-                    moved_to_duplicate = handle_existing_file(
-                        alt_file_path, source_path, duplicate_folder, target_folder, is_higher_quality
-                    )
-                    if moved_to_duplicate:
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for video_path, fingerprint in zip(missing_paths, executor.map(get_video_fingerprint, missing_paths)):
+            fingerprints[video_path] = fingerprint
+            if hash_index is not None and fingerprint is not None:
+                hash_index.set_video_fingerprint(video_path, fingerprint)
+
+    return fingerprints
+
+@lru_cache(maxsize=None)
+def get_popcount_table():
+    return np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+def get_bit_block(values, shift, width):
+    """Bits shift to shift + width of every element of a uint64 array, in the smallest unsigned type that fits."""
+    dtype = np.uint16 if width <= 16 else np.uint32 if width <= 32 else np.uint64
+    return ((values >> np.uint64(shift)) & np.uint64((1 << width) - 1)).astype(dtype)
+
+def popcount64(values):
+    """Number of set bits of every element of a uint64 array."""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    return get_popcount_table()[values.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+class HashStore:
+    """
+    Compact store of 64-bit perceptual hashes: a sorted NumPy uint64 array with a parallel array of file ids,
+    8 + 8 bytes per entry. Exact lookups use np.searchsorted. Near lookups use the multi-index built by
+    enable_near_index, without it they XOR the query against every hash and count the differing bits.
+    New entries go to an unsorted buffer of the same layout, which lookups scan as well, and are merged
+    into the sorted arrays in bulk.
+    The arrays are saved as a single .npy file that is memory-mapped on load, so large libraries load instantly.
+    """
+
+    RECORD_DTYPE = [("hash", "<u8"), ("file_id", "<i8")]
+    MIN_MERGE_SIZE = 4096
+
+    def __init__(self, hashes=None, file_ids=None):
+        self.hashes = np.empty(0, dtype=np.uint64) if hashes is None else hashes
+        self.file_ids = np.empty(0, dtype=np.int64) if file_ids is None else file_ids
+        # entries that haven't been merged into the sorted arrays yet, the first pending_count are used
+        self.pending_hashes = np.empty(self.MIN_MERGE_SIZE, dtype=np.uint64)
+        self.pending_file_ids = np.empty(self.MIN_MERGE_SIZE, dtype=np.int64)
+        self.pending_count = 0
+        # multi-index for find_near: (shift, width) of every bit block and (sorted keys, positions, key shift)
+        self.near_max_distance = -1
+        self.near_blocks = []
+        self.near_index = None
+
+    def __len__(self):
+        return len(self.hashes) + self.pending_count
+
+    def add(self, hash_value, file_id=-1):
+        if self.find(hash_value) is not None:
+            return
+        if self.pending_count == len(self.pending_hashes):
+            self.pending_hashes = np.resize(self.pending_hashes, 2 * self.pending_count)
+            self.pending_file_ids = np.resize(self.pending_file_ids, 2 * self.pending_count)
+        self.pending_hashes[self.pending_count] = hash_value
+        self.pending_file_ids[self.pending_count] = file_id
+        self.pending_count += 1
+        # merging costs a copy of the whole store, so it only happens once the buffer is a fraction of it.
+        # Near lookups scan the buffer, with a near index it is kept at about sqrt(n) entries instead
+        if self.near_blocks:
+            merge_size = max(self.MIN_MERGE_SIZE, 16 * math.isqrt(len(self.hashes)))
+        else:
+            merge_size = max(self.MIN_MERGE_SIZE, len(self.hashes) // 8)
+        if self.pending_count >= merge_size:
+            self.flush()
+
+    def add_many(self, hashes, file_ids):
+        """Insert arrays of hashes and file ids in one vectorized merge."""
+        self.flush()
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        file_ids = np.asarray(file_ids, dtype=np.int64)
+        merged_hashes = np.concatenate([self.hashes, hashes])
+        merged_file_ids = np.concatenate([self.file_ids, file_ids])
+        # stable sort keeps the first file id of a hash in front, which is the one find returns
+        order = np.argsort(merged_hashes, kind="stable")
+        self.hashes = merged_hashes[order]
+        self.file_ids = merged_file_ids[order]
+        if self.near_blocks:
+            self.build_near_index()
+
+    def enable_near_index(self, max_distance):
+        """
+        Index the hashes for find_near queries up to max_distance with multi-index hashing: the 64 bits are split
+        into max_distance + 1 blocks, and a hash that differs in at most max_distance bits equals the query in at
+        least one of them. The blocks are sorted and searched with np.searchsorted, only the hashes that share a
+        block with the query are compared bit by bit. Costs 8 bytes per entry and block, 12 below 4 blocks.
+        """
+        block_count = max_distance + 1
+        self.near_max_distance = max_distance
+        self.near_blocks = []
+        shift = 0
+        for block in range(block_count):
+            width = 64 // block_count + (1 if block < 64 % block_count else 0)
+            self.near_blocks.append((shift, width))
+            shift += width
+        self.build_near_index()
+
+    def build_near_index(self):
+        # the blocks are kept in one sorted array keyed by block number and block value, so a query needs one
+        # searchsorted call for all of its blocks
+        key_type = np.uint32 if max(width for _, width in self.near_blocks) <= 16 else np.uint64
+        key_shift = 16 if key_type is np.uint32 else 32
+        keys, positions = [], []
+        for block, (shift, width) in enumerate(self.near_blocks):
+            block_values = get_bit_block(self.hashes, shift, width)
+            # block values of up to 16 bits are radix sorted, so rebuilding after a merge stays linear
+            block_positions = np.argsort(block_values, kind="stable").astype(np.int32)
+            keys.append(block_values[block_positions].astype(key_type) | key_type(block << key_shift))
+            positions.append(block_positions)
+        self.near_index = (np.concatenate(keys), np.concatenate(positions), key_shift)
+
+    def flush(self):
+        if self.pending_count:
+            pending_hashes = self.pending_hashes[:self.pending_count].copy()
+            pending_file_ids = self.pending_file_ids[:self.pending_count].copy()
+            self.pending_count = 0
+            self.add_many(pending_hashes, pending_file_ids)
+
+    def contains_many(self, hashes):
+        """Return a boolean array telling which of the hashes are stored."""
+        self.flush()
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        positions = np.searchsorted(self.hashes, hashes)
+        found = positions < len(self.hashes)
+        found[found] = self.hashes[positions[found]] == hashes[found]
+        return found
+
+    def find(self, hash_value):
+        """Return the file id stored for hash_value, or None."""
+        position = np.searchsorted(self.hashes, np.uint64(hash_value))
+        if position < len(self.hashes) and self.hashes[position] == hash_value:
+            return int(self.file_ids[position])
+        pending_matches = np.flatnonzero(self.pending_hashes[:self.pending_count] == np.uint64(hash_value))
+        if len(pending_matches):
+            return int(self.pending_file_ids[pending_matches[0]])
+        return None
+
+    def find_near(self, hash_value, max_distance):
+        """Return [(distance, hash, file id)] of every stored hash within max_distance bits, closest first."""
+        hashes, file_ids = self.hashes, self.file_ids
+        if 0 <= max_distance <= self.near_max_distance:
+            # candidates are the hashes equal to the query in at least one block
+            keys, positions, key_shift = self.near_index
+            # the queries have to have the array's type, or searchsorted converts the whole array first
+            query_keys = np.array([(block << key_shift) | ((hash_value >> shift) & ((1 << width) - 1))
+                                   for block, (shift, width) in enumerate(self.near_blocks)], dtype=keys.dtype)
+            starts = keys.searchsorted(query_keys, side="left").tolist()
+            ends = keys.searchsorted(query_keys, side="right").tolist()
+            candidates = [positions[start:end] for start, end in zip(starts, ends)]
+            candidates = np.concatenate(candidates)
+            # a hash can share several blocks with the query, only the few that are close enough are deduplicated
+            candidates = np.unique(candidates[popcount64(hashes[candidates] ^ np.uint64(hash_value)) <= max_distance])
+            hashes, file_ids = hashes[candidates], file_ids[candidates]
+
+        matches = []
+        # the buffer is scanned in place, a near lookup never forces a merge
+        for hashes, file_ids in ((hashes, file_ids),
+                                 (self.pending_hashes[:self.pending_count], self.pending_file_ids[:self.pending_count])):
+            distances = popcount64(hashes ^ np.uint64(hash_value))
+            for i in np.flatnonzero(distances <= max_distance).tolist():
+                matches.append((int(distances[i]), int(hashes[i]), int(file_ids[i])))
+        return sorted(matches, key=lambda match: match[0])
+
+    def save(self, store_path):
+        self.flush()
+        records = np.empty(len(self.hashes), dtype=self.RECORD_DTYPE)
+        records["hash"] = self.hashes
+        records["file_id"] = self.file_ids
+        temporary_path = store_path + ".tmp.npy"
+        np.save(temporary_path, records)
+        os.replace(temporary_path, store_path)
+
+    @classmethod
+    def load(cls, store_path):
+        records = np.load(store_path, mmap_mode="r")
+        return cls(records["hash"], records["file_id"])
+
+def get_video_key(video_name):
+    """Videos are matched by name, with the " - Copy" / " (n)" part of copies removed."""
+    return re.sub(r"( - Copy| \(\d+\))(?=\.)", "", os.path.basename(video_name))
+
+def get_key_hash(key):
+    """64-bit hash of a string key, so keys can be kept in a HashStore instead of a set of strings."""
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+class DuplicateState:
+    """
+    Everything sort_duplicates remembers across batches: a HashStore with the hashes and file ids of all
+    originals seen so far, which near duplicate mode queries through its multi-index with HashStore.find_near,
+    and a HashStore with the hashed keys of original videos.
+    """
+
+    def __init__(self, hamming_threshold=0, original_hashes=None):
+        self.hamming_threshold = hamming_threshold
+        self.original_hashes = original_hashes if original_hashes is not None else HashStore()
+        if self.hamming_threshold > 0:
+            # near lookups go through a multi-index over the store, not a scan of every original
+            self.original_hashes.enable_near_index(self.hamming_threshold)
+        self.original_videos = HashStore()
+        # round(duration) -> [(path, duration, size)] of original videos, for content based matching
+        self.original_video_durations = defaultdict(list)
+        self.query_times = []
+
+    def add_original(self, hash_value, file_id=-1):
+        self.original_hashes.add(hash_value, file_id)
+
+    def add_originals(self, hashes, file_ids):
+        """Bulk insert of originals, hashes that are already known are skipped."""
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        file_ids = np.asarray(file_ids, dtype=np.int64)
+        hashes, first_positions = np.unique(hashes, return_index=True)
+        file_ids = file_ids[first_positions]
+        new_hashes = ~self.original_hashes.contains_many(hashes)
+        self.original_hashes.add_many(hashes[new_hashes], file_ids[new_hashes])
+
+    def find_original(self, hash_value, file_id=-1):
+        """
+        Return the hash of a matching original, exact first and then the closest within the threshold.
+        The entry of the file itself is ignored, originals of earlier runs are still in the source folder.
+        """
+        original_file_id = self.original_hashes.find(hash_value)
+        if original_file_id is not None and (file_id < 0 or original_file_id != file_id):
+            return hash_value
+        if self.hamming_threshold > 0:
+            # resized or recompressed copies only differ in a few bits of the perceptual hash
+            query_start = time.perf_counter()
+            near_matches = [match for match in self.original_hashes.find_near(hash_value, self.hamming_threshold)
+                            if file_id < 0 or match[2] != file_id]
+            self.query_times.append(time.perf_counter() - query_start)
+            if near_matches:
+                return near_matches[0][1]
+        return None
+
+    def add_original_video(self, video_path, duration, size):
+        self.original_video_durations[round(duration)].append((video_path, duration, size))
+
+    def find_video_candidates(self, duration, size):
+        """Original videos of about the same duration and a plausible size, the only ones worth decoding."""
+        candidates = []
+        for duration_bucket in (round(duration) - 1, round(duration), round(duration) + 1):
+            for video_path, original_duration, original_size in self.original_video_durations.get(duration_bucket, []):
+                if abs(original_duration - duration) > VIDEO_DURATION_TOLERANCE:
+                    continue
+                if max(size, original_size) > VIDEO_MAX_SIZE_RATIO * max(min(size, original_size), 1):
+                    continue
+                candidates.append(video_path)
+        return candidates
+
+    def match_videos(self, video_paths, workers=1, hash_index=None):
+        """
+        Return {path: original path} for the videos that duplicate an earlier original, the others become originals.
+        Durations come from the mvhd atom, only videos with an original of the same duration are fingerprinted.
+        """
+        video_info = {}
+        for video_path in video_paths:
+            try:
+                video_info[video_path] = (get_media_duration(video_path), os.path.getsize(video_path))
+            except Exception as e:
+                log_event(logging.WARNING, "Error reading duration of {path}: {error}", path=video_path, error=e)
+
+        # register the batch as if every video was an original to find all pairs that need decoding
+        pending_paths = set()
+        added_videos = []
+        for video_path, (duration, size) in video_info.items():
+            candidates = self.find_video_candidates(duration, size)
+            if candidates:
+                pending_paths.add(video_path)
+                pending_paths.update(candidates)
+            self.add_original_video(video_path, duration, size)
+            added_videos.append((video_path, duration))
+        for video_path, duration in added_videos:
+            self.original_video_durations[round(duration)].remove((video_path, duration, video_info[video_path][1]))
+
+        fingerprints = fingerprint_videos(sorted(pending_paths), workers, hash_index)
+
+        matches = {}
+        for video_path, (duration, size) in video_info.items():
+            fingerprint = fingerprints.get(video_path)
+            if fingerprint is not None:
+                for candidate_path in self.find_video_candidates(duration, size):
+                    candidate_fingerprint = fingerprints.get(candidate_path)
+                    if candidate_fingerprint is not None and fingerprints_match(fingerprint, candidate_fingerprint):
+                        matches[video_path] = candidate_path
                         break
+            if video_path not in matches:
+                self.add_original_video(video_path, duration, size)
+        return matches
 
-        if moved_to_duplicate:
-            continue
+    def print_stats(self):
+        if self.query_times:
+            log_event(logging.INFO, "Near duplicate search: {queries} queries over {size} hashes, avg {average:.3f} ms, max {max:.3f} ms",
+                      queries=len(self.query_times), size=len(self.original_hashes),
+                      average=1000 * sum(self.query_times) / len(self.query_times), max=1000 * max(self.query_times))
 
-        # Check if the exact file already exists in the target folder
-        if os.path.exists(destination_path):
-            if duplicate_folder:
-                duplicate_path = os.path.join(duplicate_folder, file_name)
-                print(f"File {file_name} already exists in {target_folder}. Moving to duplicate folder.")
-                move_file_to_folder(source_path, duplicate_path)
+def sort_duplicates(source_folder, manual_check_duplicates_folder, broken_photos_folder, duplicate_photos_folder, hash_index=None, library_folder="", hamming_threshold=0, recursive=False, batch_size=100, hash_store_path="", video_fingerprints=False, workers=1):
+    """
+    Move duplicates, broken images and unverifiable copies out of the source folder, batch_size files at a time.
+    Each batch is hashed and moved before the next one is read, only compact hash arrays are kept across batches.
+    With hash_store_path the original hashes of earlier runs are memory-mapped from disk and saved again at the end,
+    together with their hash index file ids, so an original of an earlier run isn't taken for a copy of itself.
+    With video_fingerprints, videos are also compared by content: sampled frame hashes of clips with the same duration.
+    """
+    if hash_store_path and hash_index is None:
+        raise ValueError("hash_store_path needs a hash index to tell the stored originals apart")
+    original_hashes = HashStore.load(hash_store_path) if hash_store_path and os.path.exists(hash_store_path) else None
+    state = DuplicateState(hamming_threshold, original_hashes)
+    # files named like copies whose original hasn't shown up yet, their names are needed to move them at the end
+    # and their keys (image hash or hashed video key) are kept in uint64 arrays, one per batch
+    unverified_copy_names = []
+    unverified_copy_keys = []
+    unverified_copy_videos = []
+
+    if hash_index is not None and library_folder:
+        # seed the originals with the sorted library, so incoming copies of already sorted files are found too
+        hash_index.index_folder(library_folder)
+        library_hashes = []
+        library_file_ids = []
+        for file_id, library_path, average_hash, sha256 in hash_index.get_folder_hashes(library_folder):
+            if average_hash is not None:
+                library_hashes.append(int(average_hash, 16))
+                library_file_ids.append(file_id)
+            elif video_fingerprints and is_video_file(library_path):
+                try:
+                    state.add_original_video(library_path, get_media_duration(library_path), os.path.getsize(library_path))
+                except Exception as e:
+                    log_event(logging.WARNING, "Error reading duration of {path}: {error}", path=library_path, error=e)
+        state.add_originals(library_hashes, library_file_ids)
+
+    for batch in iter_chunks(scan_files(source_folder, recursive), batch_size):
+        duplicate_images = {} # image name -> hash of the original it duplicates
+        broken_images = [] # images that couldn't be processed
+
+        batch_copy_keys = []
+        batch_copy_videos = []
+        video_matches = {} # video path -> path of the original video with the same content
+        if video_fingerprints:
+            video_paths = [entry.path for image_name, entry in batch if is_video_file(image_name) and not is_duplicate_name(image_name)]
+            video_matches = state.match_videos(video_paths, workers, hash_index)
+
+        # every file is hashed once, the hash index also skips files that haven't changed since the last run
+        for image_name, entry in batch:
+            log_event(logging.DEBUG, "Processing image: {file_name}", file_name=image_name)
+            image_hash = None
+            sha256 = None
+            broken = False
+            file_id = -1
+            if hash_index is not None:
+                image_hash, sha256, broken = hash_index.get_hashes(entry.path, entry.stat())
+                file_id = hash_index.get_file_id(entry.path)
             else:
-                print(f"File {file_name} already exists in {target_folder}.")
-            continue
-
-        # Move the file to the target folder
-        move_file_to_folder(source_path, destination_path)
+                image_hash = None if is_video_file(image_name) else get_image_hash(entry.path)
+                broken = image_hash is None
+
+            # the same content already in the sorted library, looked up by the indexed digest column
+            in_library = sha256 is not None and library_folder and hash_index.find_digest(sha256, library_folder) is not None
+
+            if is_video_file(image_name):
+                video_key = get_video_key(image_name)
+                if in_library:
+                    duplicate_images[image_name] = "video_" + video_key
+                elif entry.path in video_matches:
+                    duplicate_images[image_name] = "video_" + video_matches[entry.path]
+                elif is_duplicate_name(image_name):
+                    unverified_copy_names.append(image_name)
+                    batch_copy_keys.append(get_key_hash(video_key))
+                    batch_copy_videos.append(True)
+                else:
+                    state.original_videos.add(get_key_hash(video_key))
+                continue
 
-def copy_files(source_folder, file_names, target_folder):
-    for file_name in file_names:
-        file_path = os.path.join(source_folder, file_name)
-        destination_path = os.path.join(target_folder, file_name)
+            if broken:
+                broken_images.append(image_name)
+                continue
 
-        if os.path.exists(destination_path):
-            print(f"File {file_name} already exists in {destination_path}. Skipping...")
-            continue
+            hash_value = int(str(image_hash), 16)
+            original_hash = state.find_original(hash_value, file_id)
+            if in_library or original_hash is not None:
+                duplicate_images[image_name] = f"{original_hash if original_hash is not None else hash_value:016x}"
+            elif is_duplicate_name(image_name):
+                # the original can still come up in a later batch
+                unverified_copy_names.append(image_name)
+                batch_copy_keys.append(hash_value)
+                batch_copy_videos.append(False)
+            else:
+                state.add_original(hash_value, file_id)
+
+        unverified_copy_keys.append(np.array(batch_copy_keys, dtype=np.uint64))
+        unverified_copy_videos.append(np.array(batch_copy_videos, dtype=bool))
+
+        duplicate_clusters = defaultdict(list)
+        for image_name, original_hash in duplicate_images.items():
+            duplicate_clusters[original_hash].append(image_name)
+        for original_hash, cluster in duplicate_clusters.items():
+            original_path = None
+            if original_hash.startswith("video_"):
+                original_path = original_hash[len("video_"):]
+            elif hash_index is not None:
+                original_path = hash_index.get_path(state.original_hashes.find(int(original_hash, 16)))
+            log_event(logging.INFO, "Duplicate cluster {key} (original: {original}): {cluster}",
+                      key=original_hash, original=original_path or "unknown", cluster=cluster)
+        metrics.count("broken", len(broken_images))
+        metrics.count("duplicates", len(duplicate_images))
+        move_files(source_folder, broken_images, broken_photos_folder)
+        move_files(source_folder, list(duplicate_images), duplicate_photos_folder)
+
+    # copies are verified once all originals are known, the ones without an original need a manual check
+    verified_copies = []
+    manual_check_duplicates = []
+    copy_keys = np.concatenate(unverified_copy_keys) if unverified_copy_keys else np.empty(0, dtype=np.uint64)
+    copy_videos = np.concatenate(unverified_copy_videos) if unverified_copy_videos else np.empty(0, dtype=bool)
+    for image_name, copy_key, is_video in zip(unverified_copy_names, copy_keys.tolist(), copy_videos.tolist()):
+        if is_video:
+            is_verified = state.original_videos.find(copy_key) is not None
+        else:
+            is_verified = state.find_original(copy_key) is not None
+        (verified_copies if is_verified else manual_check_duplicates).append(image_name)
 
-        try:
-            shutil.copy(file_path, destination_path)
-            print(f"Copied file: {file_path}")
-        except Exception as e:
-            print(f"Error moving {file_path} to {destination_path}: {e}")
-
-def sort_duplicates(source_folder, manual_check_duplicates_folder, broken_photos_folder, duplicate_photos_folder):
-    # Dictionary to map image hashes to their file names
-    hash_map = defaultdict(list)
-    duplicate_images = {}
-    broken_images = [] # images that either couldn't be processed or cannot be identified as duplicates
-
-    # get all the image names from the source_folder
-    image_names = [f for f in os.listdir(source_folder) if os.path.isfile(os.path.join(source_folder, f))]
-
-    for i in range(len(image_names)):
-        duplicate_evaluation = check_if_duplicate_image(source_folder, image_names[i], hash_map)
-        if duplicate_evaluation is None:
-            broken_images.append(image_names[i])
-            continue;
-        
-        if (duplicate_evaluation["duplicate"]):
-            duplicate_images[duplicate_evaluation["image_name"]] = duplicate_evaluation["image_hash"]
-        elif duplicate_evaluation:
-            hash_map[duplicate_evaluation["image_hash"]] = image_names[i]
-
-    for i in range(len(image_names)):
-        print("Processing image: " + image_names[i])
-        duplicate_evaluation = check_if_duplicate_image(source_folder, image_names[i], hash_map)
-        if duplicate_evaluation is None:
-            broken_images.append(image_names[i])
-            continue;
-        if (duplicate_evaluation["duplicate"]):
-            duplicate_images[duplicate_evaluation["image_name"]] = duplicate_evaluation["image_hash"]
-        elif duplicate_evaluation:
-            hash_map[duplicate_evaluation["image_hash"]] = image_names[i]
-
-    # double check if the hash for the duplicates exist, otherwise add them to the manual check duplicates
-    updated_duplicate_images, manual_check_duplicates = verify_duplicates(duplicate_images, hash_map)
-    print("Duplicates paths: " + str(updated_duplicate_images))
-    print("Files to manually check for duplicates: " + str(manual_check_duplicates))
+    log_event(logging.INFO, "Verified copies: {files}", files=verified_copies)
+    log_event(logging.INFO, "Files to manually check for duplicates: {files}", files=manual_check_duplicates)
+    metrics.count("verified_copies", len(verified_copies))
+    metrics.count("manual_check", len(manual_check_duplicates))
+    state.print_stats()
 
     move_files(source_folder, manual_check_duplicates, manual_check_duplicates_folder)
-    move_files(source_folder, broken_images, broken_photos_folder)
-    move_files(source_folder, updated_duplicate_images, duplicate_photos_folder)
+    move_files(source_folder, verified_copies, duplicate_photos_folder)
+
+    if hash_store_path:
+        state.original_hashes.save(hash_store_path)
 
 
 def create_file_name(image_date, image_time, file_geo_data):
@@ -332,182 +1906,677 @@ def create_file_name(image_date, image_time, file_geo_data):
     else:
         return image_date + "_" + image_time
 
-def rename_file(path, original_name, new_name):
-
-    old_path = os.path.join(path, original_name)
-    
-    
-    if ("." in original_name):
-        file_extension = original_name.split(".")[1]
-        new_name += "." + file_extension
-    
-    new_path = os.path.join(path, new_name)
-    
-    print(old_path)
-    print(new_path)
-    os.rename(old_path, new_path)
-
-    print(original_name + " renamed to -> " + new_name)
-    return new_name
+def get_renamed_file_name(original_name, new_name):
+    """Return new_name with the extension of original_name."""
+    return new_name + os.path.splitext(os.path.basename(original_name))[1]
 
+def parse_sorted_name(file_name):
+    """Return the SORTED_NAME_PATTERN match of a file name without its extension, or None if it isn't sorted yet."""
+    sorted_name = SORTED_NAME_PATTERN.match(os.path.splitext(os.path.basename(file_name))[0])
+    if sorted_name is not None and not sorted_name["country"] and not is_video_file(file_name):
+        return None
+    return sorted_name
+
+def read_mp4_movie_header(video_path):
+    """Return (creation seconds since 1904-01-01 UTC, duration in seconds) from moov/mvhd, or None if there is none."""
+    with open(video_path, "rb") as file:
+        moov_size = find_box(file, b"moov")
+        if moov_size is None:
+            return None
+        mvhd_size = find_box(file, b"mvhd", file.tell() + moov_size)
+        if mvhd_size is None or mvhd_size < 20:
+            return None
+        mvhd = file.read(min(mvhd_size, 32))
+
+    # the box header can promise more than a truncated file still has
+    if len(mvhd) < 20:
+        return None
+    if mvhd[0] == 1:
+        if len(mvhd) < 32:
+            return None
+        creation_time, _, timescale, duration = struct.unpack_from(">QQIQ", mvhd, 4)
+    else:
+        creation_time, _, timescale, duration = struct.unpack_from(">IIII", mvhd, 4)
+    return creation_time, duration / timescale if timescale else 0.0
 
-def rename_folder(path, original_name, new_name):
-    old_path = os.path.join(path, original_name)
-    new_path = os.path.join(path, new_name)
-    
-    os.rename(old_path, new_path)
-    print(original_name + " folder renamed to -> " + new_name)
+def get_mp4_creation_time(video_path):
+    """Read creation_time straight from the mvhd atom, formatted the same way ffprobe reports it."""
+    movie_header = read_mp4_movie_header(video_path)
+    if movie_header is None or movie_header[0] == 0:
+        return None
+    creation_time = MP4_EPOCH + timedelta(seconds=movie_header[0])
+    return creation_time.strftime("%Y-%m-%dT%H:%M:%S.000000Z")
 
-def get_media_created(video_path):
-    print(video_path)
+def get_ffprobe_creation_time(video_path):
     probe = ffmpeg.probe(video_path)
     if 'format' in probe and 'tags' in probe['format']:
         media_created = probe['format']['tags'].get('creation_time')
         return media_created
     else:
         return None
-    
-def create_datetime_and_country_folder(parent_folder_path, datetime, country):
-    folder_name = datetime + "_" + country
-    folder_path = os.path.join(parent_folder_path, folder_name)
-    os.mkdir(folder_path)
-    print("New folder created in path: " + folder_path)
 
+def probe_media_created(video_paths, workers=1):
+    """
+    Return {path: creation_time} for a batch of media files, timed as the probe_mvhd and probe_ffprobe stages.
+    MP4/QuickTime files are read directly from their mvhd atom, everything that can't be parsed that way
+    goes through ffprobe, with the subprocesses running concurrently in a shared thread pool.
+    """
+    media_created = {}
+    ffprobe_paths = []
 
-def update_datetime_and_country_folder(parent_folder_path, original_folder_name, country):
+    for video_path in video_paths:
+        if os.path.splitext(video_path)[1].lower() not in MP4_EXTENSIONS:
+            ffprobe_paths.append(video_path)
+            continue
+        start = time.perf_counter()
+        try:
+            creation_time = get_mp4_creation_time(video_path)
+        except (OSError, struct.error):
+            creation_time = None
+        metrics.observe("probe_mvhd", time.perf_counter() - start)
+        if creation_time is None:
+            ffprobe_paths.append(video_path)
+        else:
+            media_created[video_path] = creation_time
+
+    def timed_ffprobe(video_path):
+        start = time.perf_counter()
+        try:
+            creation_time = get_ffprobe_creation_time(video_path)
+        except Exception as e:
+            log_event(logging.WARNING, "Error probing {path}: {error}", path=video_path, error=e)
+            creation_time = None
+        return creation_time, time.perf_counter() - start
+
+    if ffprobe_paths:
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            for video_path, (creation_time, seconds) in zip(ffprobe_paths, executor.map(timed_ffprobe, ffprobe_paths)):
+                media_created[video_path] = creation_time
+                metrics.observe("probe_ffprobe", seconds)
+
+    return media_created
+
+def get_media_created(video_path):
+    return probe_media_created([video_path])[video_path]
+    
+def get_updated_folder_name(original_folder_name, country):
+    """Return the folder name with country added to its country list, or None if it is already there."""
     folder_parts = original_folder_name.split("_")
     if (len(folder_parts) > 2):
         countries = folder_parts[-1].split(",")
         if country in countries:
-            return
+            return None
         else:
-            new_folder_name = original_folder_name + "," + country
+            return original_folder_name + "," + country
     else:
-        new_folder_name = original_folder_name + "_" + country
-    rename_folder(parent_folder_path, original_folder_name, new_folder_name)
-                    
-
-def move_file_to_specific_datetime_folder(source_folder, parent_target_folder, file_name, file_date, file_country, duplicate_folder=""):
-    file_year_month = file_date[0:6]
-    folder_names = [f for f in os.listdir(parent_target_folder) if os.path.isdir(os.path.join(parent_target_folder, f))]
-    if (len(folder_names) > 0):
-        for folder_name in folder_names:
-            folder_year_month = folder_name.split("_")[0] + folder_name.split("_")[1]
-            if folder_year_month == file_year_month:
-                current_folder_path = os.path.join(parent_target_folder, folder_name)
-                if (file_country == ""):
-                    # find something taken on the same day and use that country
-                    subfolder_files = [f for f in os.listdir(current_folder_path) if os.path.isfile(os.path.join(current_folder_path, f))]
-                    for subfolder_file in subfolder_files:
-                        existing_file_date = subfolder_file.split("_")[1]
-                        if file_date == existing_file_date:
-                            same_day_file_country = subfolder_file.split("_")[0]
-                            new_file_name = same_day_file_country + "_" + file_name
-                            new_file_name = rename_file(source_folder, file_name, new_file_name)
-                           
-                            move_files(source_folder, [new_file_name], current_folder_path, duplicate_folder)
-                            return
-
-                    move_files(source_folder, [file_name], current_folder_path, duplicate_folder) # no similar file made on that day, don't use the country
- 
+        return original_folder_name + "_" + country
 
-                else:
-                    target_folder = os.path.join(parent_target_folder, folder_name)
-                    move_files(source_folder, [file_name], target_folder, duplicate_folder)
-                    update_datetime_and_country_folder(parent_target_folder, folder_name, file_country)
-                return
-    
-    folder_date = file_date[0:4] + "_" +  file_date[4:6]
-    folder_name = file_date[0:4] + "_" +  file_date[4:6] + "_" + file_country
-    create_datetime_and_country_folder(parent_target_folder, folder_date, file_country)
-    target_folder = os.path.join(parent_target_folder, folder_name)
-    move_files(source_folder, [file_name], target_folder, duplicate_folder)
+class LibraryIndex:
+    """
+    In-memory view of the sorted library, built with a single scan and kept up to date as files are placed.
+    - month_folders: "YYYYMM" -> name of the {YYYY}_{MM}_{Countries} folder for that month
+    - day_countries: "YYYYMMDD" -> country codes of the files taken on that day, in folder listing order
+    - taken_names: sorted name without extension -> {file name: get_file_identity of its content} of every placed
+      file, read once when the file is added, the registry allocate_name picks collision-free names from without
+      touching the filesystem
+    """
 
+    def __init__(self, parent_folder):
+        self.parent_folder = parent_folder
+        self.month_folders = {}
+        self.day_countries = defaultdict(list)
+        self.taken_names = defaultdict(dict)
 
+        for folder_name in os.listdir(parent_folder):
+            folder_parts = folder_name.split("_")
+            folder_path = os.path.join(parent_folder, folder_name)
+            if len(folder_parts) < 2 or not os.path.isdir(folder_path):
+                continue
+            # like the folder scan this replaces, only the first folder of a month is used
+            if folder_parts[0] + folder_parts[1] in self.month_folders:
+                continue
+            self.month_folders[folder_parts[0] + folder_parts[1]] = folder_name
+            for file_name in os.listdir(folder_path):
+                file_path = os.path.join(folder_path, file_name)
+                # only sorted names are registered, the others don't need reading
+                if parse_sorted_name(file_name) is not None and os.path.isfile(file_path):
+                    self.add_file(file_name, get_file_identity(file_path))
+
+    def add_file(self, file_name, identity=None):
+        """Record a placed file, names with a country also offer it to files taken on the same day."""
+        sorted_name = parse_sorted_name(file_name)
+        if sorted_name is None:
+            return
+        if sorted_name["country"]:
+            self.day_countries[sorted_name["date"]].append(sorted_name["country"])
+        self.taken_names[os.path.splitext(file_name)[0]][file_name] = identity
+
+    def is_same_content(self, first_identity, second_identity):
+        return (first_identity is not None and second_identity is not None
+                and (first_identity["size"], first_identity["digest"]) == (second_identity["size"], second_identity["digest"]))
+
+    def is_same_shot(self, first_identity, second_identity):
+        """Pictures are the same shot if their sub-second times match, or without them, their dimensions."""
+        if first_identity is None or second_identity is None:
+            return False
+        if first_identity["subsec"] and second_identity["subsec"]:
+            return first_identity["subsec"] == second_identity["subsec"]
+        return first_identity["dimensions"] is not None and first_identity["dimensions"] == second_identity["dimensions"]
+
+    def is_name_free(self, file_stem, file_extension, identity):
+        """
+        A name is free unless another file has it. Copies of the same content share it on purpose, like variants
+        of the same shot with another of QUALITY_PRIORITY's extensions, duplicate resolution decides later.
+        Other extensions are never ranked against each other, so they don't take each other's names.
+        """
+        file_extension = file_extension.lower()
+        for taken_name, taken_identity in self.taken_names.get(file_stem, {}).items():
+            taken_extension = os.path.splitext(taken_name)[1].lower()
+            if taken_extension == file_extension:
+                if not self.is_same_content(identity, taken_identity):
+                    return False
+            elif file_extension in QUALITY_PRIORITY and taken_extension in QUALITY_PRIORITY:
+                if not self.is_same_shot(identity, taken_identity):
+                    return False
+        return True
 
+    def allocate_name(self, file_name, subsec="", identity=None):
+        """
+        Return the name a file is placed under: file_name if it's free, else with the EXIF sub-second time,
+        else with the first free -{sequence} suffix. Burst shots from the same second get distinct names this way.
+        """
+        return allocate_free_name(file_name, lambda name: self.is_name_free(*os.path.splitext(name), identity), subsec)
+
+    def plan_placement(self, file_date, file_country):
+        """
+        Decide where a file taken on file_date goes and update the index as if that already happened:
+        - folder: name of the month folder the file ends up in (before any rename)
+        - create_folder: the folder doesn't exist yet
+        - rename_folder_to: new folder name once the file's country has been added, or None
+        - country_prefix: country of a file taken on the same day, for files without their own country
+        """
+        file_year_month = file_date[0:6]
+        placement = {"folder": None, "create_folder": False, "rename_folder_to": None, "country_prefix": ""}
+
+        folder_name = self.month_folders.get(file_year_month)
+        if folder_name is None:
+            placement["folder"] = file_date[0:4] + "_" + file_date[4:6] + "_" + file_country
+            placement["create_folder"] = True
+            self.month_folders[file_year_month] = placement["folder"]
+            return placement
+
+        placement["folder"] = folder_name
+        if (file_country == ""):
+            # find something taken on the same day and use that country
+            same_day_countries = self.day_countries.get(file_date)
+            if same_day_countries:
+                placement["country_prefix"] = same_day_countries[0]
+        else:
+            placement["rename_folder_to"] = get_updated_folder_name(folder_name, file_country)
+            if placement["rename_folder_to"] is not None:
+                self.month_folders[file_year_month] = placement["rename_folder_to"]
+        return placement
 
-def sort_pictures_into_folders(source_folder, target_folder, duplicate_folder="", unsorted_folder=""):
+def extract_file_metadata(source_folder, file_name, media_created=None):
+    """
+    Read everything needed to name and place a single file, without touching the filesystem layout.
+    Runs inside the worker processes, so the result has to be a plain picklable dictionary:
+    - action: "place" (rename if new_name is set, then move), "unsorted" or "error"
+    - new_name: new file name without extension, or None if the file is already named
+    - date / country: used to pick the {YYYY}_{MM}_{Countries} target folder
+    - gps / time: coordinates and time of geotagged images, which still need geocoding
+    - subsec: EXIF sub-second time of images, used to tell apart burst shots that would get the same name
+    media_created is the creation time probe_media_created found for a video, None if it found none.
+    """
+    metadata = {"file_name": file_name, "action": "place", "new_name": None, "date": None, "country": "", "error": None, "gps": None, "time": None, "subsec": None}
 
-    file_names = [f for f in os.listdir(source_folder) if os.path.isfile(os.path.join(source_folder, f))]
+    try:
+        # if the file already has the correct name, then just move it {Country Code}_{YYYYMMDD}_{HHMMSS}
+        sorted_name = parse_sorted_name(file_name)
+        if sorted_name is not None:
+            metadata["date"] = sorted_name["date"]
+            metadata["country"] = sorted_name["country"] or ""
+            return metadata
 
-    i = 0
-    for file_name in file_names:
+        file_path = os.path.join(source_folder, file_name)
+
+        # processing for videos
+        if is_video_file(file_path):
+            # the batch probe already tried the mvhd atom and ffprobe, probing again would only fail the same way
+            video_data = media_created
+            if video_data is None:
+                raise ValueError("No creation time found")
+            video_date = video_data.split("T")[0].replace("-", "")
+            video_time = ((video_data.split("T")[1]).split(".")[0]).replace(":", "")
+            metadata["new_name"] = create_file_name(video_date, video_time, "")
+            metadata["date"] = video_date
+            return metadata
+
+        image_data = extract_exif(file_path)
+
+        if image_data == None:
+            metadata["action"] = "unsorted"
+            return metadata
+
+        image_datetime = image_data["DateTime"]
+        file_date = (image_datetime.split(" "))[0].replace(":", "")
+        file_time = (image_datetime.split(" "))[1].replace(":", "")
+
+        if "GPS" not in image_data:
+            raise ValueError("No GPS metadata found")
+        # the country and the new name are filled in by geocode_metadata for the whole batch
+        metadata["gps"] = (image_data["GPS"]["Latitude"], image_data["GPS"]["Longitude"])
+        metadata["date"] = file_date
+        metadata["time"] = file_time
+        metadata["subsec"] = image_data.get("SubSecTime")
+
+    except Exception as e:
+        metadata["action"] = "error"
+        metadata["error"] = str(e)
+
+    return metadata
 
+def iter_chunks(items, chunk_size):
+    iterator = iter(items)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+def geocode_metadata(metadata_results, geocode_cache, chunk_size=256):
+    """Fill in the country and new name of geotagged images, geocoding each chunk of results in one batch."""
+    for chunk in iter_chunks(metadata_results, chunk_size):
+        geotagged = [metadata for metadata in chunk if metadata["gps"] is not None and metadata["action"] == "place"]
         try:
-            check_file_name_changed = file_name.split("_")
-            # if the file already has the correct name, then just move it {Country Code}_{YYYYMMDD}_{HH:MM:SS}
-            if len(check_file_name_changed) == 3:
-                file_split = file_name.split("_")
-                file_date = file_split[1]
-                file_country = file_split[0]
-                move_file_to_specific_datetime_folder(source_folder, target_folder, file_name, file_date, file_country, duplicate_folder)
-                continue
-            file_path = os.path.join(source_folder, file_name)
-            file_extension = os.path.splitext(file_path)[1].lower()
-
-            # processing for videos
-            if (file_extension == ".mov" or file_extension == ".mp4" or file_extension == ".mp3"):
-                print(file_name)
-                video_data = get_media_created(file_path)
-                video_date = video_data.split("T")[0].replace("-", "")
-                video_time = ((video_data.split("T")[1]).split(".")[0]).replace(":", "")
-                new_video_name = create_file_name(video_date, video_time, "")
-                print("File name: " + file_name)
-                new_video_name = rename_file(source_folder, file_name, new_video_name)
-                move_file_to_specific_datetime_folder(source_folder, target_folder, new_video_name, video_date, "", duplicate_folder)
-                continue
-            
-            image_data = extract_exif(file_path)
+            geo_data = geocode_cache.lookup_batch([metadata["gps"] for metadata in geotagged])
+            for metadata, image_geo_data in zip(geotagged, geo_data):
+                metadata["new_name"] = create_file_name(metadata["date"], metadata["time"], image_geo_data)
+                metadata["country"] = image_geo_data["country_code"]
+        except Exception as e:
+            # the GPS stays set, so map_manifest_metadata can tell a failed lookup from a failed extraction
+            for metadata in geotagged:
+                metadata["action"] = "error"
+                metadata["error"] = f"Geocoding failed: {e}"
+        yield from chunk
 
-            if image_data == None:
-                move_files(source_folder, [file_name], unsorted_folder, duplicate_folder)
-                continue
+def scan_files(folder, recursive=False, relative_to=None):
+    """
+    Lazily yield (path relative to the scanned root, os.DirEntry) for every file below folder.
+    os.scandir reports the entry type from the directory listing itself, so no extra stat is needed per file,
+    and the caller can start working before a large folder has been listed completely.
+    """
+    relative_to = relative_to or folder
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_file():
+                yield os.path.relpath(entry.path, relative_to), entry
+            elif recursive and entry.is_dir(follow_symlinks=False):
+                yield from scan_files(entry.path, recursive, relative_to)
+
+def extract_file_metadata_in_worker(source_folder, file_name, media_created=None):
+    """extract_file_metadata for a worker process, the metrics it recorded are sent back with the result."""
+    metrics.reset()
+    metadata = extract_file_metadata(source_folder, file_name, media_created)
+    return metadata, metrics.snapshot()
+
+def map_file_metadata(source_folder, file_names, workers=1, chunk_size=256):
+    """
+    Lazily yield extract_file_metadata results in the same order as file_names, which can be any iterable.
+    Videos of each chunk are probed together first, then with more than one worker the EXIF reads,
+    decoding and ffprobe calls run in a process pool with a bounded number of files in flight.
+    """
+    executor = None
+    if workers > 1:
+        # the process pool pulls in multiprocessing, which single worker runs and --help don't need
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=workers)
+    pending = deque()
+
+    try:
+        for chunk in iter_chunks(file_names, chunk_size):
+            # video creation times are probed in one batch, mostly straight from the mvhd atom
+            video_paths = [os.path.join(source_folder, f) for f in chunk if is_video_file(f)]
+            media_created = probe_media_created(video_paths, workers)
+
+            for file_name in chunk:
+                file_media_created = media_created.get(os.path.join(source_folder, file_name))
+                if executor is None:
+                    yield extract_file_metadata(source_folder, file_name, file_media_created)
+                else:
+                    pending.append(executor.submit(extract_file_metadata_in_worker, source_folder, file_name, file_media_created))
+
+            while len(pending) > 2 * chunk_size:
+                yield merge_worker_result(pending.popleft().result())
+
+        while pending:
+            yield merge_worker_result(pending.popleft().result())
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
 
-            elif (file_extension == ".heic"):
-                image_datetime = image_data["DateTime"]
-                file_date = (image_datetime.split(" "))[0].replace(":", "")
-                file_time = (image_datetime.split(" "))[1].replace(":", "")
-                image_gps = (image_data["GPS"]["Latitude"], image_data["GPS"]["Longitude"])
-                image_geo_data = get_data_from_geocode(image_gps)
-                new_file_name = create_file_name(file_date, file_time, image_geo_data)
-            
+def map_manifest_metadata(source_folder, scanned_files, manifest, geocode_cache, workers=1, chunk_size=256):
+    """
+    Lazily yield metadata for (relative path, DirEntry) pairs in scan order, reading it from the manifest where possible.
+    Only files the manifest doesn't know in their current state go through extraction and geocoding, their results
+    are recorded. Files that failed before are skipped, they would only fail the same way again. Files whose
+    geocoding failed are not recorded, so they are extracted and geocoded again on the next run.
+    """
+    # (file name, path, stat, quick digest, recorded metadata or None) of files passed on, in scan order
+    scan_order = deque()
+
+    def new_file_names():
+        for file_name, entry in scanned_files:
+            file_stat = entry.stat()
+            metadata, digest = manifest.get_metadata(entry.path, file_name, file_stat)
+            if metadata is not None and metadata["action"] == "error":
+                log_event(logging.DEBUG, "Skipping {file_name}, it failed before: {error}", file_name=file_name, error=metadata["error"])
+                metrics.count("files_skipped")
+                continue
+            scan_order.append((file_name, entry.path, file_stat, digest, metadata))
+            if metadata is None:
+                yield file_name
             else:
-                image_datetime = image_data["DateTime"]
-                file_date = (image_datetime.split(" "))[0].replace(":", "")
-                file_time = (image_datetime.split(" "))[1].replace(":", "")
-                image_gps = extract_image_gps_info(file_path)
-                image_geo_data = get_data_from_geocode(image_gps)
-                new_file_name = create_file_name(file_date, file_time, image_geo_data)
+                metrics.count("files_from_manifest")
+
+    extracted_results = geocode_metadata(map_file_metadata(source_folder, new_file_names(), workers, chunk_size), geocode_cache, chunk_size)
+    for metadata in extracted_results:
+        # everything scanned before this file came from the manifest
+        while scan_order[0][0] != metadata["file_name"]:
+            yield scan_order.popleft()[4]
+        _, file_path, file_stat, digest, _ = scan_order.popleft()
+        # extraction errors never come with GPS, these are geocoding errors, which may not happen again
+        if metadata["action"] != "error" or metadata["gps"] is None:
+            manifest.record(file_path, metadata, file_stat, digest)
+        yield metadata
+    while scan_order:
+        yield scan_order.popleft()[4]
+
+def merge_worker_result(result):
+    metadata, worker_metrics = result
+    metrics.merge(worker_metrics)
+    return metadata
+
+def plan_file_moves(source_folder, target_folder, metadata_results, library_index, unsorted_folder=""):
+    """
+    Decide the final folder and name of every file of a batch without touching anything.
+    Names come from the library index's registry, so they never collide with a file that is already placed
+    or planned, and month folders get their final name straight away, so each file is renamed and moved in one step.
+    Returns the operations with the folder operations first and the moves grouped by destination folder.
+    """
+    created_months = set()
+    renamed_months = {} # YYYYMM -> folder name before this run
+    moves = []
 
-            file_country = image_geo_data["country_code"]
-            new_file_name = rename_file(source_folder, file_name, new_file_name)
-            move_file_to_specific_datetime_folder(source_folder, target_folder, new_file_name, file_date, file_country, duplicate_folder)
+    for metadata in metadata_results:
+        source_path = os.path.join(source_folder, metadata["file_name"])
+        file_name = os.path.basename(metadata["file_name"])
 
-        except Exception as e:
-            print(f"Error processing file {file_name}: {e}") 
-        
+        metrics.count("files_" + metadata["action"])
+        if metadata["action"] == "error":
+            log_event(logging.WARNING, "Error processing file {file_name}: {error}", file_name=file_name, error=metadata["error"])
+            continue
+        if metadata["action"] == "unsorted":
+            moves.append({"op": "move", "source": source_path, "folder": unsorted_folder, "file_name": file_name})
+            continue
 
-if __name__ == "__main__":
-    # Load config
-    config = configparser.ConfigParser()
-    config.read('config.ini')
+        if metadata["new_name"] is not None:
+            file_name = get_renamed_file_name(file_name, metadata["new_name"])
+
+        month = metadata["date"][0:6]
+        placement = library_index.plan_placement(metadata["date"], metadata["country"])
+        if placement["create_folder"]:
+            created_months.add(month)
+        elif placement["rename_folder_to"] is not None:
+            renamed_months.setdefault(month, placement["folder"])
+
+        if placement["country_prefix"]:
+            file_name = get_renamed_file_name(file_name, placement["country_prefix"] + "_" + os.path.splitext(file_name)[0])
+
+        identity = get_file_identity(source_path)
+        file_name = library_index.allocate_name(file_name, metadata["subsec"] or "", identity)
+        library_index.add_file(file_name, identity)
+        moves.append({"op": "move", "source": source_path, "month": month, "file_name": file_name})
+
+    operations = []
+    for month in sorted(created_months):
+        operations.append({"op": "mkdir", "path": os.path.join(target_folder, library_index.month_folders[month])})
+    for month, original_folder_name in renamed_months.items():
+        if month not in created_months:
+            operations.append({"op": "rename_folder", "source": os.path.join(target_folder, original_folder_name),
+                               "target": os.path.join(target_folder, library_index.month_folders[month])})
+
+    for move in moves:
+        if "month" in move:
+            move["folder"] = os.path.join(target_folder, library_index.month_folders[move.pop("month")])
+    # sorting is stable, so files keep their input order within a folder
+    moves.sort(key=lambda move: move["folder"])
+
+    return operations + moves
+
+def apply_move_operation(operation):
+    """
+    Apply one planned folder operation. Operations that already happened before an interruption are skipped,
+    an error is logged and the run carries on with the next operation.
+    """
+    try:
+        if operation["op"] == "mkdir":
+            os.makedirs(operation["path"], exist_ok=True)
+        elif operation["op"] == "rename_folder":
+            transfer_engine.flush()
+            if os.path.isdir(operation["source"]) and not os.path.exists(operation["target"]):
+                os.rename(operation["source"], operation["target"])
+                folder_listing.forget(operation["source"])
+                folder_listing.forget(operation["target"])
+                log_event(logging.INFO, "{source} folder renamed to -> {target}", source=operation["source"], target=operation["target"])
+    except Exception as e:
+        metrics.count("operation_errors")
+        log_event(logging.ERROR, "Error applying {op} operation {operation}: {error}", op=operation["op"], operation=operation, error=e)
+    metrics.count("journal_operations")
 
-    pillow_heif.register_heif_opener() # opener for .heic files
+def apply_planned_moves(operations, duplicate_folder=""):
+    """
+    Resolve the planned moves of a batch against the files already in their folders with a single
+    plan_duplicate_resolution call and queue the result. Moves whose source is gone happened before an interruption.
+    """
+    transfers = [(operation["source"], operation["folder"], operation["file_name"])
+                 for operation in operations if transfer_engine.exists(operation["source"])]
+    try:
+        apply_resolution_plan(plan_duplicate_resolution(transfers, duplicate_folder))
+    except Exception:
+        # find the moves that can't be planned, the others still go ahead, names the failed plan took are listed again
+        for folder in {transfer[1] for transfer in transfers} | {duplicate_folder}:
+            folder_listing.forget(folder)
+        for transfer in transfers:
+            try:
+                apply_resolution_plan(plan_duplicate_resolution([transfer], duplicate_folder))
+            except Exception as e:
+                metrics.count("operation_errors")
+                log_event(logging.ERROR, "Error moving {source} to {folder}: {error}", source=transfer[0], folder=transfer[1], error=e)
+    metrics.count("journal_operations", len(operations))
+
+def write_move_journal(journal_path, operations):
+    """
+    Write the full move plan as the first record of the journal before anything is moved.
+    The plan is written to a temporary file first, so a journal is either complete or not there at all.
+    """
+    temporary_path = journal_path + ".tmp"
+    with open(temporary_path, "w") as journal:
+        journal.write(json.dumps({"plan": operations}) + "\n")
+        journal.flush()
+        os.fsync(journal.fileno())
+    os.replace(temporary_path, journal_path)
+
+def apply_move_journal(journal_path, duplicate_folder=""):
+    """
+    Second phase of a transactional run: apply the planned operations, appending a record for each one.
+    An interrupted run continues with the operations without a record and the journal is removed at the end.
+    Folder operations are recorded one by one, the moves are resolved as one plan and recorded once it has been applied.
+    """
+    with open(journal_path) as journal:
+        records = []
+        for line in journal:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # the last record can be cut off by a crash, its operation is simply applied again
+                break
+
+    # a journal without its plan was never applied, there is nothing to resume
+    if not records or "plan" not in records[0]:
+        log_event(logging.WARNING, "Move journal {path} has no plan, nothing to resume", path=journal_path)
+        os.remove(journal_path)
+        return
+    operations = records[0]["plan"]
+    done_operations = {record["done"] for record in records[1:]}
+
+    remaining_operations = [index for index in range(len(operations)) if index not in done_operations]
+    move_operations = [index for index in remaining_operations if operations[index]["op"] == "move"]
+    with open(journal_path, "a") as journal, transfer_engine.batch(), folder_listing.scope():
+        # plan_file_moves puts the folder operations first, the moves go to the final folder names
+        for index in remaining_operations:
+            if operations[index]["op"] != "move":
+                apply_move_operation(operations[index])
+                journal.write(json.dumps({"done": index}) + "\n")
+        journal.flush()
+
+        apply_planned_moves([operations[index] for index in move_operations], duplicate_folder)
+        transfer_engine.flush()
+        for index in move_operations:
+            journal.write(json.dumps({"done": index}) + "\n")
+        journal.flush()
+
+    os.remove(journal_path)
+
+def sort_pictures_into_folders(source_folder, target_folder, duplicate_folder="", unsorted_folder="", workers=1, journal_path="", geocode_cache=None, recursive=False, batch_size=100, manifest=None):
+    """
+    Rename and move every file of the source folder into the {YYYY}_{MM}_{Countries} folders of the target folder.
+    With a manifest, files already read by an earlier run go straight to placement and files that failed are skipped.
+    """
 
+    # the interrupted batch of a transactional run is finished from its journal, without reading its metadata again
+    if journal_path and os.path.exists(journal_path):
+        log_event(logging.WARNING, "Resuming interrupted run from {path}", path=journal_path)
+        apply_move_journal(journal_path, duplicate_folder)
 
-    # get all the folder configurations
-    source_folder = config['Folders']['source_folder']
-    sorted_photos_folder = config['Folders']['sorted_photos_folder']
-    duplicate_photos_folder = config["Folders"]["duplicate_photos_folder"]
-    broken_photos_folder = config["Folders"]["broken_photos_folder"]
-    unsorted_folder = config["Folders"]["unsorted_folder"]
+    # files are streamed from the scanner, so processing starts before the source is fully listed
+    scanned_files = scan_files(source_folder, recursive)
 
-    # example file path for testing
-    example_file_path = config["Files"]["example_file_path"]
+    # the target library is scanned once, placements keep the index up to date
+    library_index = LibraryIndex(target_folder)
 
-    # Sort duplicates into specified folders
-    #sort_duplicates(source_folder, manual_check_duplicates_folder, broken_photos_folder, duplicate_photos_folder)
+    geocode_cache = geocode_cache or GeocodeCache()
+    if manifest is not None:
+        metadata_results = map_manifest_metadata(source_folder, scanned_files, manifest, geocode_cache, workers, batch_size)
+    else:
+        file_names = (file_name for file_name, _ in scanned_files)
+        metadata_results = map_file_metadata(source_folder, file_names, workers, batch_size)
+        metadata_results = geocode_metadata(metadata_results, geocode_cache, batch_size)
+
+    # every batch is planned in full first, names and folders are decided in scan order
+    # so folder creation and renaming see the same sequence of files as a serial run
+    for batch in iter_chunks(metadata_results, batch_size):
+        operations = plan_file_moves(source_folder, target_folder, batch, library_index, unsorted_folder)
+        if journal_path:
+            # the plan is journaled before anything is moved, so an interrupted batch can be resumed
+            write_move_journal(journal_path, operations)
+            apply_move_journal(journal_path, duplicate_folder)
+        else:
+            # folder operations come first, then the moves are resolved as one plan, queued and run concurrently
+            with transfer_engine.batch(), folder_listing.scope():
+                for operation in operations:
+                    if operation["op"] != "move":
+                        apply_move_operation(operation)
+                apply_planned_moves([operation for operation in operations if operation["op"] == "move"], duplicate_folder)
+
+    geocode_cache.print_stats()
+    geocode_cache.save()
+        
 
-    sort_pictures_into_folders(source_folder, sorted_photos_folder, duplicate_photos_folder, unsorted_folder)
+def load_config(config_path):
+    config = configparser.ConfigParser()
+    config.read(config_path)
+
+    # per-file events are logged at DEBUG, with a log path every event is also written there as a JSON line
+    setup_logging(config["Settings"].get("log_level", "INFO").upper(), config["Files"].get("log_path", ""))
+
+    # transfers run concurrently within a batch, bounded per device, and can be verified by checksum after copying
+    transfer_engine.per_device_limit = config["Settings"].getint("transfers_per_device", fallback=4)
+    transfer_engine.verify = config["Settings"].getboolean("verify_transfers", fallback=False)
+    return config
+
+def run_sort(config):
+    folders = config["Folders"]
+
+    # number of processes used for reading metadata, 1 keeps everything in the main process
+    workers = config["Settings"].getint("workers", fallback=1)
+    # number of files read, hashed and moved together, bounds the memory used by a run
+    batch_size = config["Settings"].getint("batch_size", fallback=100)
+    # with a journal path the moves are planned first and an interrupted run can be resumed
+    move_journal_path = config["Files"].get("move_journal_path", "")
+    # reverse geocoding results are cached by rounded coordinates and kept between runs
+    geocode_cache = GeocodeCache(config["Files"].get("geocode_cache_path", ""), config["Settings"].getint("geocode_precision", fallback=3))
+    # also sort files from subfolders of the source folder
+    recursive = config["Settings"].getboolean("recursive", fallback=False)
+    # processed files and their metadata are kept in the manifest, so re-runs skip everything already read
+    manifest_path = config["Files"].get("manifest_path", "")
+
+    with FileManifest(manifest_path) if manifest_path else nullcontext() as manifest:
+        sort_pictures_into_folders(folders["source_folder"], folders["sorted_photos_folder"], folders["duplicate_photos_folder"],
+                                   folders["unsorted_folder"], workers, move_journal_path, geocode_cache, recursive, batch_size, manifest)
+
+def run_dedupe(config):
+    folders = config["Folders"]
+
+    # maximum number of differing perceptual hash bits for two images to count as duplicates, 0 means exact matches only
+    hamming_threshold = config["Settings"].getint("hamming_threshold", fallback=0)
+    # compare videos by sampled frames instead of only by name when looking for duplicates
+    video_fingerprints = config["Settings"].getboolean("video_fingerprints", fallback=False)
+
+    # hashes are cached in the index between runs
+    with HashIndex(config["Files"]["hash_index_path"]) as hash_index:
+        sort_duplicates(folders["source_folder"], folders["manual_check_duplicates_folder"], folders["broken_photos_folder"],
+                        folders["duplicate_photos_folder"], hash_index, folders["sorted_photos_folder"], hamming_threshold,
+                        config["Settings"].getboolean("recursive", fallback=False), config["Settings"].getint("batch_size", fallback=100),
+                        config["Files"].get("hash_store_path", ""), video_fingerprints, config["Settings"].getint("workers", fallback=1))
+
+def run_index(config, folders):
+    with HashIndex(config["Files"]["hash_index_path"]) as hash_index:
+        for folder in folders or [config["Folders"]["sorted_photos_folder"]]:
+            hash_index.index_folder(folder)
+
+def cli(argv=None):
+    """
+    python main.py [--config config.ini] sort | dedupe | index [folder ...] | bench <benchmark> ...
+    Every backend (Pillow, pillow-heif, imagehash, NumPy, reverse_geocode, ffmpeg) is imported on first use,
+    so a command only loads what it actually touches.
+    """
+    parser = argparse.ArgumentParser(description="Sort photos and videos into dated country folders")
+    parser.add_argument("--config", default="config.ini")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("sort", help="rename and move the source folder into the sorted library")
+    subparsers.add_parser("dedupe", help="move duplicates and broken files out of the source folder")
+    index_parser = subparsers.add_parser("index", help="hash a folder into the hash index, the sorted library by default")
+    index_parser.add_argument("folders", nargs="*")
+    bench_parser = subparsers.add_parser("bench", help="run a benchmark from bench.py")
+    bench_parser.add_argument("bench_args", nargs=argparse.REMAINDER)
+    args = parser.parse_args(argv)
+
+    if args.command == "bench":
+        import bench
+        bench.run(args.bench_args)
+        return
+
+    config = load_config(args.config)
+    # with a profile path the whole run is profiled with cProfile and the stats are saved there
+    with profiled(config["Files"].get("profile_path", "")):
+        if args.command == "sort":
+            run_sort(config)
+        elif args.command == "dedupe":
+            run_dedupe(config)
+        elif args.command == "index":
+            run_index(config, args.folders)
+    metrics.print_summary()
 
-    #print(extract_exif(example_file_path))
\ No newline at end of file
+if __name__ == "__main__":
+    cli()
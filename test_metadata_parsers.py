@@ -0,0 +1,142 @@
+"""
+Round trips for the header-only metadata parsers in main.py: EXIF from JPEG and HEIC files written by piexif,
+frame sizes from the JPEG SOF and HEIF ispe boxes, MP4 mvhd times, and truncated input of each.
+"""
+from datetime import datetime
+import os
+import struct
+
+import piexif
+import pillow_heif
+import pytest
+from PIL import Image
+
+import main
+
+TAKEN = datetime(2023, 5, 1, 12, 30, 15)
+LATITUDE = 48.8566
+LONGITUDE = -74.006
+
+
+def to_gps_rational(value):
+    degrees = int(value)
+    minutes = int((value - degrees) * 60)
+    seconds = round((value - degrees - minutes / 60) * 3600 * 100)
+    return ((degrees, 1), (minutes, 1), (seconds, 100))
+
+def make_exif(with_gps=True):
+    date_time = TAKEN.strftime("%Y:%m:%d %H:%M:%S").encode()
+    gps = {}
+    if with_gps:
+        gps = {
+            piexif.GPSIFD.GPSLatitudeRef: b"N",
+            piexif.GPSIFD.GPSLatitude: to_gps_rational(LATITUDE),
+            piexif.GPSIFD.GPSLongitudeRef: b"W",
+            piexif.GPSIFD.GPSLongitude: to_gps_rational(abs(LONGITUDE)),
+            piexif.GPSIFD.GPSAltitudeRef: 1,
+            piexif.GPSIFD.GPSAltitude: (355, 10),
+        }
+    return piexif.dump({
+        "0th": {piexif.ImageIFD.DateTime: date_time},
+        "Exif": {piexif.ExifIFD.DateTimeOriginal: date_time, piexif.ExifIFD.SubSecTime: b"042"},
+        "GPS": gps,
+    })
+
+def make_mp4(path, creation_time, duration, version=0):
+    def box(box_type, body):
+        return struct.pack(">I4s", 8 + len(body), box_type) + body
+
+    if version == 1:
+        mvhd = b"\1\0\0\0" + struct.pack(">QQIQ", creation_time, creation_time, 1000, int(duration * 1000)) + b"\0" * 80
+    else:
+        mvhd = b"\0\0\0\0" + struct.pack(">IIII", creation_time, creation_time, 1000, int(duration * 1000)) + b"\0" * 80
+    with open(path, "wb") as file:
+        file.write(box(b"ftyp", b"isom\0\0\0\0isommp41"))
+        file.write(box(b"mdat", b"\0" * 4096))
+        file.write(box(b"moov", box(b"mvhd", mvhd)))
+
+@pytest.fixture
+def jpeg_path(tmp_path):
+    path = tmp_path / "photo.jpg"
+    Image.new("RGB", (320, 240), (200, 30, 30)).save(path, "JPEG", exif=make_exif())
+    return str(path)
+
+@pytest.fixture
+def heic_path(tmp_path):
+    pillow_heif.register_heif_opener()
+    path = tmp_path / "photo.heic"
+    Image.new("RGB", (320, 240), (30, 30, 200)).save(path, format="HEIF", exif=make_exif())
+    return str(path)
+
+def check_exif(image_data):
+    assert image_data["DateTime"] == "2023:05:01 12:30:15"
+    assert image_data["SubSecTime"] == "042"
+    assert image_data["GPS"]["Latitude"] == pytest.approx(LATITUDE, abs=1e-5)
+    assert image_data["GPS"]["Longitude"] == pytest.approx(LONGITUDE, abs=1e-5)
+    assert image_data["GPS"]["Altitude"] == pytest.approx(-35.5)
+
+def test_jpeg_exif_round_trip(jpeg_path):
+    check_exif(main.extract_exif(jpeg_path))
+
+def test_heic_exif_round_trip(heic_path):
+    check_exif(main.extract_exif(heic_path))
+
+def test_exif_matches_piexif(jpeg_path):
+    expected = piexif.load(jpeg_path)
+    parsed = main.read_exif_dict(jpeg_path)
+    assert parsed["0th"][piexif.ImageIFD.DateTime] == expected["0th"][piexif.ImageIFD.DateTime].decode()
+    assert parsed["GPS"][piexif.GPSIFD.GPSLatitude] == expected["GPS"][piexif.GPSIFD.GPSLatitude]
+    assert parsed["GPS"][piexif.GPSIFD.GPSLongitude] == expected["GPS"][piexif.GPSIFD.GPSLongitude]
+
+def test_image_without_gps(tmp_path):
+    path = str(tmp_path / "no_gps.jpg")
+    Image.new("RGB", (64, 48)).save(path, "JPEG", exif=make_exif(with_gps=False))
+    image_data = main.extract_exif(path)
+    assert image_data["DateTime"] == "2023:05:01 12:30:15"
+    assert "GPS" not in image_data
+
+def test_jpeg_frame_info(jpeg_path):
+    with open(jpeg_path, "rb") as file:
+        assert main.read_jpeg_frame_info(file) == (320, 240, 8)
+
+def test_heif_image_info(heic_path):
+    with open(heic_path, "rb") as file:
+        assert main.read_heif_image_info(file) == (320, 240, 8)
+
+@pytest.mark.parametrize("fixture_name", ["jpeg_path", "heic_path"])
+def test_truncated_images(request, tmp_path, fixture_name):
+    image_path = request.getfixturevalue(fixture_name)
+    data = open(image_path, "rb").read()
+    truncated_path = str(tmp_path / ("truncated" + os.path.splitext(image_path)[1]))
+    # every cut through the headers has to end in None or a partial result, never in an exception
+    for size in range(0, min(len(data), 2048), 7):
+        with open(truncated_path, "wb") as file:
+            file.write(data[:size])
+        image_data = main.read_file_exif(truncated_path)
+        assert image_data is None or isinstance(image_data, dict)
+        quality = main.get_media_quality(truncated_path)
+        assert len(quality) == 4
+
+def test_garbage_tiff():
+    assert main.parse_exif_tiff(None) is None
+    assert main.parse_exif_tiff(b"XX\0\0\0\0\0\0") is None
+    # an IFD offset past the end of the block reads as empty
+    assert main.parse_exif_tiff(b"MM\0\x2a\xff\xff\xff\xff")["0th"] == {}
+
+@pytest.mark.parametrize("version", [0, 1])
+def test_mp4_movie_header(tmp_path, version):
+    path = str(tmp_path / "clip.mp4")
+    creation_time = int((TAKEN - main.MP4_EPOCH.replace(tzinfo=None)).total_seconds())
+    make_mp4(path, creation_time, 12.5, version)
+    assert main.read_mp4_movie_header(path) == (creation_time, 12.5)
+    assert main.get_mp4_creation_time(path) == "2023-05-01T12:30:15.000000Z"
+
+def test_truncated_mp4(tmp_path):
+    path = str(tmp_path / "clip.mp4")
+    make_mp4(path, 3000000000, 5.0)
+    data = open(path, "rb").read()
+    for size in range(0, len(data), 5):
+        with open(path, "wb") as file:
+            file.write(data[:size])
+        movie_header = main.read_mp4_movie_header(path)
+        assert movie_header is None or movie_header == (3000000000, 5.0)